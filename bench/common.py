@@ -0,0 +1,59 @@
+# vim: set ts=4 sts=4 sw=4 et tw=0:
+""" Helpers shared by the benchmark scripts """
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def percentile(values, pct):
+    """ nearest rank percentile of sorted values """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def scratch_home(home=None):
+    """
+        Point HOME at a scratch folder, so that tsp keeps its database,
+        lock and sockets there.  Must be called before tsp is imported.
+
+    """
+    home = home or tempfile.mkdtemp(prefix='tsp-bench-')
+    os.makedirs(os.path.join(home, '.cache'), exist_ok=True)
+    os.environ['HOME'] = home
+    return home
+
+
+def start_daemon(*args):
+    """ run tsp --run for the current HOME, returns once it serves the API """
+    from tsp.client import api_path # pylint: disable=import-outside-toplevel
+
+    proc = subprocess.Popen([sys.executable, '-c', 'from tsp.cli import main; main()',
+                             '-q', '--run', *args])
+    for _ in range(500):
+        if os.path.exists(api_path()):
+            break
+        time.sleep(0.01)
+    return proc
+
+
+def stop_daemon(proc):
+    """ stop a daemon started by start_daemon """
+    proc.terminate()
+    proc.wait()
+
+
+def summary(seconds):
+    """ millisecond percentiles of a list of durations """
+    values = sorted(seconds)
+    if not values:
+        return None
+    return {
+        'count': len(values),
+        'p50': round(percentile(values, 50) * 1000, 3),
+        'p99': round(percentile(values, 99) * 1000, 3),
+        'max': round(values[-1] * 1000, 3),
+    }
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# vim: set ts=4 sts=4 sw=4 et tw=0:
+"""
+    Many-writer contention benchmark
+
+    Starts a daemon against a scratch HOME (or uses the one given with --home)
+    and lets N processes add tasks concurrently, the way `tsp <cmd>` does:
+    through the daemon's API, or with --direct by writing to the database.
+    Reports enqueue throughput, latency percentiles and lock errors as JSON.
+
+"""
+
+import json
+import multiprocessing
+import sqlite3
+import time
+
+from optparse import OptionParser
+from common import scratch_home, start_daemon, stop_daemon, summary
+
+
+def adder(args):
+    """ add tasks one transaction at a time, returns latencies and lock errors """
+    count, command, direct = args
+
+    # imported here so that tsp picks up the HOME set by main()
+    from tsp.client import request # pylint: disable=import-outside-toplevel
+    from tsp.database import Database # pylint: disable=import-outside-toplevel
+    from tsp.wakeup import wake_daemon # pylint: disable=import-outside-toplevel
+
+    latencies = []
+    errors = 0
+    for _ in range(count):
+        start = time.perf_counter()
+        try:
+            if direct:
+                with Database(immediate=True) as db:
+                    db.add_task(command.split())
+                wake_daemon()
+            elif 'id' not in request({'op': 'add', 'command': command.split()}):
+                raise sqlite3.OperationalError('daemon failed to add the task')
+        except sqlite3.OperationalError:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+
+    return latencies, errors
+
+
+def main():
+    """ run the benchmark """
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-n", "--adders", type="int", default=16,
+                      help="concurrent adding processes")
+    parser.add_option("-t", "--tasks", type="int", default=200,
+                      help="tasks added by each process")
+    parser.add_option("-c", "--command", default="true",
+                      help="command of the added tasks")
+    parser.add_option("--slots", type="int", default=4,
+                      help="slots of the spawned daemon")
+    parser.add_option("--direct", action="store_true",
+                      help="write to the database instead of using the daemon's API")
+    parser.add_option("--home",
+                      help="use the daemon already running for this HOME")
+    (opts, _) = parser.parse_args()
+
+    scratch_home(opts.home)
+
+    daemon = None
+    if not opts.home:
+        daemon = start_daemon('--slots', str(opts.slots))
+
+    try:
+        start = time.perf_counter()
+        with multiprocessing.Pool(opts.adders) as pool:
+            results = pool.map(adder, [(opts.tasks, opts.command, opts.direct)] * opts.adders)
+        elapsed = time.perf_counter() - start
+    finally:
+        if daemon:
+            stop_daemon(daemon)
+
+    latencies = [lat for lats, _ in results for lat in lats]
+    print(json.dumps({
+        'adders': opts.adders,
+        'api': not opts.direct,
+        'tasks': len(latencies),
+        'seconds': round(elapsed, 3),
+        'tasks_per_second': round(len(latencies) / elapsed, 1),
+        'latency_ms': summary(latencies),
+        'lock_errors': sum(errors for _, errors in results),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# vim: set ts=4 sts=4 sw=4 et tw=0:
+"""
+    CLI startup benchmark
+
+    Times the short lived invocations against a scratch HOME, so that
+    import and schema bootstrap costs show up next to each other:
+
+    - import: cumulative `-X importtime` of tsp.cli and its largest imports
+    - add, list: wall-clock of `tsp <cmd>` and `tsp -p` as a fresh process
+
+"""
+
+import json
+import subprocess
+import sys
+import time
+
+from optparse import OptionParser
+from common import scratch_home, summary
+
+CLI = [sys.executable, '-c', 'from tsp.cli import main; main()']
+
+
+def import_times(top):
+    """ cumulative import microseconds of tsp.cli, and its top imports """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import tsp.cli'],
+                          capture_output=True, text=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = max(times.get(name.strip(), 0), int(cumulative))
+
+    largest = sorted(times.items(), key=lambda item: item[1], reverse=True)
+    return {
+        'tsp.cli_us': times['tsp.cli'],
+        'largest_us': dict(largest[1:top + 1]),
+    }
+
+
+def wall_clock(args, runs):
+    """ latencies of running the CLI with args as a fresh process """
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(CLI + args, stdout=subprocess.DEVNULL, check=True)
+        latencies.append(time.perf_counter() - start)
+    return summary(latencies)
+
+
+def main():
+    """ run the benchmark """
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-n", "--runs", type="int", default=50,
+                      help="invocations timed per command")
+    parser.add_option("--top", type="int", default=10,
+                      help="largest imports to report")
+    (opts, _) = parser.parse_args()
+
+    scratch_home()
+    # creates and migrates the database, so the runs below time the common case
+    subprocess.run(CLI + ['-q', '-p'], stdout=subprocess.DEVNULL, check=True)
+
+    print(json.dumps({
+        'python': sys.version.split()[0],
+        'import': import_times(opts.top),
+        'add_ms': wall_clock(['-q', 'true'], opts.runs),
+        'list_ms': wall_clock(['-q', '-p'], opts.runs),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# vim: set ts=4 sts=4 sw=4 et tw=0:
+"""
+    Benchmark suite
+
+    Runs against a scratch HOME and prints one JSON document, so that runs
+    before and after a change can be compared:
+
+    - enqueue: Database.add_task one transaction per task, like `tsp <cmd>`,
+      and Database.add_tasks in one transaction, like `tsp --batch`
+    - dispatch: add -> start latency of `true` through a running daemon
+    - listing: get_next_task and list_* latency on synthetic tables, with the
+      query plans of the statements they run; the script exits with 1 when
+      one of them no longer uses its index
+    - rss: daemon peak RSS while it captures a large output
+    - codecs: stored size and compress/decompress cost of each output codec
+      on log-like outputs
+
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import time
+
+from optparse import OptionParser
+from common import scratch_home, start_daemon, stop_daemon, summary
+
+# index each listing statement must search, by Database method
+PLANS = {
+    'get_next_task': 'IDX_tasks_ready',
+    'coalesce': 'IDX_tasks_hash',
+    'next_due': 'IDX_tasks_waiting',
+    'list_pending_tasks': 'IDX_tasks_pending',
+    'list_failed_tasks': 'IDX_tasks_failed',
+    'list_waiting_tasks': 'IDX_tasks_waiting_list',
+    'purge_step': 'IDX_tasks_done',
+    'stats': 'IDX_tasks_stats',
+}
+# methods that begin and commit their own transaction
+OWN_TRANSACTION = {'get_next_task'}
+
+
+def bench_enqueue(count):
+    """ single and bulk add_task throughput """
+    from tsp.database import Database # pylint: disable=import-outside-toplevel
+
+    start = time.perf_counter()
+    for i in range(count):
+        with Database(immediate=True) as db:
+            db.add_task(['true', str(i)])
+    single = time.perf_counter() - start
+
+    commands = [f'true {i}' for i in range(count)]
+    start = time.perf_counter()
+    with Database(immediate=True) as db:
+        db.add_tasks(commands)
+    bulk = time.perf_counter() - start
+
+    with Database(immediate=True) as db:
+        db.purge_pending()
+
+    return {
+        'tasks': count,
+        'single_per_second': round(count / single, 1),
+        'bulk_per_second': round(count / bulk, 1),
+    }
+
+
+def bench_dispatch(count):
+    """ time from committing a task to the daemon marking it running """
+    from tsp.database import Database # pylint: disable=import-outside-toplevel
+    from tsp.wakeup import wake_daemon # pylint: disable=import-outside-toplevel
+
+    daemon = start_daemon()
+    latencies = []
+    try:
+        for _ in range(count):
+            with Database(immediate=True) as db:
+                task_id = db.add_task(['true'])
+            start = time.perf_counter()
+            wake_daemon()
+
+            db = Database()
+            while db.query('SELECT status FROM tasks WHERE id = ?', [task_id])[0]['status'] == 0:
+                time.sleep(0.0005)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        stop_daemon(daemon)
+
+    return {'latency_ms': summary(latencies)}
+
+
+def fill(db, rows):
+    """ synthetic history: mostly finished, some failed, a few pending """
+    from tsp.database import command_hash # pylint: disable=import-outside-toplevel
+
+    now = int(time.time())
+    batch = []
+    for i in range(rows):
+        status = 0 if i % 50 == 0 else 2
+        batch.append({
+            'added_at': now - rows + i,
+            'run_at': None if status == 0 else now - rows + i + 1,
+            'finished_at': None if status == 0 else now - rows + i + 2,
+            'command': f'fetch-mail --account {i % 17}',
+            'cmd_hash': command_hash(f'fetch-mail --account {i % 17}') if status == 0 else None,
+            'status': status,
+            'result': None if status == 0 else int(i % 10 == 0),
+            'time_r': None if status == 0 else 1.0,
+        })
+        if len(batch) == 10000:
+            db.insert_many('tasks', batch)
+            batch = []
+    if batch:
+        db.insert_many('tasks', batch)
+
+
+def query_plans(db, method, *args):
+    """ run a Database method, returns the plans of the SELECTs and UPDATEs it ran """
+    statements = []
+    db.db.set_trace_callback(statements.append)
+    try:
+        timed_call(db, method, args)
+    finally:
+        db.db.set_trace_callback(None)
+
+    plans = []
+    for sql in statements:
+        if sql.lstrip().startswith(('SELECT', 'UPDATE')):
+            rows = db.db.execute(f'EXPLAIN QUERY PLAN {sql}').fetchall()
+            plans.append(' / '.join(row[3] for row in rows))
+    return plans
+
+
+def timed_call(db, method, args):
+    """ seconds a Database method takes, its changes are rolled back if it can be """
+    own = method in OWN_TRANSACTION
+    if not own:
+        db.begin_transaction()
+    start = time.perf_counter()
+    try:
+        getattr(db, method)(*args)
+        return time.perf_counter() - start
+    finally:
+        if not own:
+            db.rollback()
+
+
+def bench_listing(home, sizes):
+    """ latency of the dispatch and list queries by table size """
+    from tsp import database # pylint: disable=import-outside-toplevel
+
+    results = {}
+    failed_plans = []
+    for rows in sizes:
+        database.DB_PATH = os.path.join(home, f'rows-{rows}', 'tasks.db')
+        db = database.Database()
+        with db:
+            fill(db, rows)
+
+        since = int(time.time()) - rows // 2
+        calls = {
+            'get_next_task': ('default',),
+            'coalesce': ('fetch-mail --account 3',),
+            'next_due': (),
+            'list_pending_tasks': (50,),
+            'list_failed_tasks': (50,),
+            'list_finished_tasks': (50,),
+            'list_last_tasks': (50,),
+            'list_waiting_tasks': (50,),
+            'purge_step': (),
+            'stats': (since,),
+        }
+
+        timings = {method: summary([timed_call(db, method, args) for _ in range(20)])
+                   for method, args in calls.items()}
+
+        plans = {method: query_plans(db, method, *calls[method]) for method in PLANS}
+        for method, index in PLANS.items():
+            if not plans[method] or index not in plans[method][0]:
+                failed_plans.append(f'{rows} rows: {method} does not use {index}: {plans[method]}')
+
+        results[rows] = {'latency_ms': timings, 'plans': plans}
+
+    return results, failed_plans
+
+
+def bench_rss(size):
+    """ daemon peak RSS while a task prints size bytes """
+    from tsp.database import Database # pylint: disable=import-outside-toplevel
+    from tsp.wakeup import wake_daemon # pylint: disable=import-outside-toplevel
+
+    daemon = start_daemon()
+    try:
+        with Database(immediate=True) as db:
+            task_id = db.add_task(['head', '-c', str(size), '/dev/zero'])
+        wake_daemon()
+
+        db = Database()
+        while db.query('SELECT status FROM tasks WHERE id = ?', [task_id])[0]['status'] != 2:
+            time.sleep(0.05)
+
+        with open(f'/proc/{daemon.pid}/status', encoding="utf-8") as f:
+            status = dict(line.split(':', 1) for line in f)
+    finally:
+        stop_daemon(daemon)
+
+    return {
+        'output_bytes': size,
+        'peak_rss_kib': int(status['VmHWM'].split()[0]),
+        'rss_kib': int(status['VmRSS'].split()[0]),
+    }
+
+
+def sample_output(i, size):
+    """ log-like output of about size bytes """
+    lines = []
+    length = 0
+    n = 0
+    while length < size:
+        line = f'2024-05-01 06:{n % 60:02}:{(i + n) % 60:02} INFO fetch-mail: account {i % 17}' \
+            f' fetched {(i * n) % 23} messages in {(i + n) % 1000} ms\n'
+        lines.append(line)
+        length += len(line)
+        n += 1
+    return ''.join(lines)[:size]
+
+
+def bench_codecs(count, size):
+    """ bytes stored and time to write and read outputs with each codec """
+    from tsp.database import compress, decompress, stored_size # pylint: disable=import-outside-toplevel
+
+    outputs = [sample_output(i, size) for i in range(count)]
+    raw = sum(stored_size(text) for text in outputs)
+    results = {}
+    for codec in ('none', 'zlib', 'lzma'):
+        start = time.perf_counter()
+        stored = [compress(text, codec) for text in outputs]
+        write = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for value in stored:
+            decompress(value)
+        read = time.perf_counter() - start
+
+        results[codec] = {
+            'bytes': sum(stored_size(value) for value in stored),
+            'ratio': round(raw / sum(stored_size(value) for value in stored), 2),
+            'write_us': round(write / count * 1e6, 2),
+            'read_us': round(read / count * 1e6, 2),
+        }
+
+    return {'outputs': count, 'output_bytes': size, 'codecs': results}
+
+
+def main():
+    """ run the suite """
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--tasks", type="int", default=1000,
+                      help="tasks added by the enqueue benchmark")
+    parser.add_option("--dispatches", type="int", default=100,
+                      help="tasks timed by the dispatch benchmark")
+    parser.add_option("--rows", default="10000,100000",
+                      help="comma separated sizes of the synthetic tables")
+    parser.add_option("--output-bytes", type="int", dest="output_bytes",
+                      default=200 * 1024 * 1024,
+                      help="size of the output captured by the rss benchmark")
+    parser.add_option("--codec-outputs", type="int", dest="codec_outputs", default=1000,
+                      help="outputs compressed by the codecs benchmark")
+    parser.add_option("--codec-bytes", type="int", dest="codec_bytes", default=4096,
+                      help="size of each of these outputs, the spool excerpt size by default")
+    parser.add_option("-o", "--output",
+                      help="write the results to this file instead of stdout")
+    (opts, _) = parser.parse_args()
+
+    home = scratch_home()
+    results = {
+        'time': int(time.time()),
+        'python': sys.version.split()[0],
+        'sqlite': sqlite3.sqlite_version,
+        'enqueue': bench_enqueue(opts.tasks),
+        'dispatch': bench_dispatch(opts.dispatches),
+        'rss': bench_rss(opts.output_bytes),
+        'codecs': bench_codecs(opts.codec_outputs, opts.codec_bytes),
+    }
+    results['listing'], failed_plans = bench_listing(
+        home, [int(n) for n in opts.rows.split(',')])
+    results['failed_plans'] = failed_plans
+
+    data = json.dumps(results, indent=2)
+    if opts.output:
+        with open(opts.output, 'w', encoding="utf-8") as f:
+            f.write(data + '\n')
+    else:
+        print(data)
+
+    return 1 if failed_plans else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,21 @@
 """ Setup logging for all modules """
 import logging
+import os
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(filename='/var/log/tsp/tsp.log', level=logging.DEBUG)
+
+LOG_FILE = '/var/log/tsp/tsp.log'
+
+def setup_logging():
+    """ log to LOG_FILE, which is only opened once something is logged """
+    if os.access(os.path.dirname(LOG_FILE), os.W_OK):
+        logging.basicConfig(handlers=[logging.FileHandler(LOG_FILE, delay=True)],
+                            level=logging.DEBUG)
+    else:
+        # on stderr, tsp.cli logs at DEBUG unless -q but only warnings belong there
+        handler = logging.StreamHandler()
+        handler.setLevel(logging.WARNING)
+        logging.basicConfig(handlers=[handler], level=logging.WARNING)
 
 # Set version
 __version__ =  "2.0"
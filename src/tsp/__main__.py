@@ -0,0 +1,4 @@
+""" python -m tsp """
+from tsp.cli import main
+
+main()
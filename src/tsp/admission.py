@@ -0,0 +1,91 @@
+# pylint: disable=logging-fstring-interpolation
+# vim: set ts=4 sts=4 sw=4 et tw=0:
+""" Admission control, holds tasks back while the host is busy """
+
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['Admission']
+
+# seconds between checks while tasks are held
+RECHECK_INTERVAL = 5
+# once held, a rule must pass with this much margin before tasks resume
+RESUME_MARGIN = 0.9
+
+
+def mem_available():
+    """ MiB of available memory from /proc/meminfo, None if unknown """
+    try:
+        with open('/proc/meminfo', encoding="utf-8") as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def pressure(resource):
+    """ 10 second 'some' pressure of our cgroup, or the system, None if unknown """
+    paths = [f'/proc/pressure/{resource}']
+    try:
+        with open('/proc/self/cgroup', encoding="utf-8") as f:
+            for line in f:
+                if line.startswith('0::'):
+                    paths.insert(0, f"/sys/fs/cgroup{line[3:].strip()}/{resource}.pressure")
+    except OSError:
+        pass
+
+    for path in paths:
+        try:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.startswith('some '):
+                        return float(dict(x.split('=') for x in line.split()[1:])['avg10'])
+        except (OSError, KeyError, ValueError):
+            continue
+    return None
+
+
+class Admission:
+    """ Rules checked before each task starts, 0 disables a rule """
+
+    def __init__(self, max_load=0, min_memory=0, max_pressure=0):
+        self.max_load = max_load
+        self.min_memory = min_memory
+        self.max_pressure = max_pressure
+        self.held = False
+
+    def check(self):
+        """ whether a task may start now """
+        reason = self.failing(RESUME_MARGIN if self.held else 1)
+
+        if reason and not self.held:
+            logger.info(f'Holding tasks: {reason}')
+        elif self.held and not reason:
+            logger.info('Resuming tasks.')
+
+        self.held = reason is not None
+        return not self.held
+
+    def failing(self, margin):
+        """ description of the first failing rule, None if all pass """
+        if self.max_load:
+            load = os.getloadavg()[0]
+            if load > self.max_load * margin:
+                return f'load average {load:.2f} above {self.max_load * margin:.2f}'
+
+        if self.min_memory:
+            available = mem_available()
+            if available is not None and available < self.min_memory / margin:
+                return f'{available:.0f} MiB available, below {self.min_memory / margin:.0f} MiB'
+
+        if self.max_pressure:
+            for resource in ('cpu', 'io'):
+                some = pressure(resource)
+                if some is not None and some > self.max_pressure * margin:
+                    return f'{resource} pressure {some:.2f} above {self.max_pressure * margin:.2f}'
+
+        return None
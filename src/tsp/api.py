@@ -0,0 +1,248 @@
+# pylint: disable=logging-fstring-interpolation
+# vim: set ts=4 sts=4 sw=4 et tw=0:
+"""
+    Submission API, a Unix stream socket served by the daemon
+
+    Requests and replies are JSON objects, one per line:
+
+        {"op": "add", "command": ["fetch-mail"], "props": {"queue": "net", "after": [3]}}
+        {"op": "replace", "command": ["fetch-mail"]}
+        {"op": "unique", "command": ["fetch-mail"]}
+        {"op": "list", "which": "pending", "limit": 50, "after_id": null}
+        {"op": "show", "id": 12}
+
+    Adds are committed together, each client gets {"id": N} back once its
+    task is committed, unique adds also {"coalesced": true} if the command
+    was already pending.  Errors are returned as
+    {"error": "..."}.
+
+"""
+
+import json
+import logging
+import os
+import selectors
+import socket
+import sqlite3
+import time
+
+from tsp.client import READ_SIZE, api_path
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['ApiServer']
+
+# seconds adds wait for others to share their transaction, with 0 the adds
+# read during one pass of the daemon's loop are committed together
+GROUP_COMMIT = int(os.getenv('TS_GROUP_COMMIT', '0')) / 1000
+LISTS = ('pending', 'waiting', 'failed', 'finished', 'last')
+# task columns only add_task itself sets
+RESERVED = {'id', 'added_at', 'command', 'cmd_hash', 'coalesced', 'blocked', 'status',
+            'attempts', 'scheduled_at'}
+# value types of the columns clients set, None leaves the column's default
+PROP_TYPES = {'queue': str, 'priority': int, 'on_fail': str, 'timeout': (int, float),
+              'not_before': int, 'every': int, 'retries': int, 'backoff': (int, float)}
+ON_FAIL = ('skip', 'run')
+
+
+class Client:
+    """ A connected client with its unparsed input and unsent replies """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbuf = b''
+        self.outbuf = b''
+        self.closed = False
+
+
+class ApiServer:
+    """ Serves the API from the scheduler's selector loop """
+
+    def __init__(self, db, selector):
+        self.db = db
+        self.selector = selector
+        # adds waiting for the next group commit
+        self.batch = []
+        self.flush_at = None
+        self.clients = set()
+        columns = self.db.query("SELECT name, \"notnull\" FROM pragma_table_info('tasks')")
+        self.columns = {row['name'] for row in columns} - RESERVED | {'after'}
+        self.nullable = {row['name'] for row in columns if not row['notnull']}
+
+        self.path = api_path()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.sock.bind(self.path)
+            os.chmod(self.path, 0o600)
+            self.sock.listen(64)
+        except OSError:
+            self.sock.close()
+            raise
+        self.sock.setblocking(False)
+        self.selector.register(self.sock, selectors.EVENT_READ, self.accept)
+
+    def accept(self, _mask):
+        """ accept waiting connections """
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except BlockingIOError:
+                return
+            sock.setblocking(False)
+            client = Client(sock)
+            self.clients.add(client)
+            self.selector.register(sock, selectors.EVENT_READ,
+                                   lambda mask, client=client: self.handle(client, mask))
+
+    def close(self):
+        """ commit queued adds, then stop listening """
+        self.flush(force=True)
+        for client in list(self.clients):
+            self.disconnect(client)
+        self.selector.unregister(self.sock)
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def disconnect(self, client):
+        """ forget a client, its queued adds are still committed """
+        client.closed = True
+        self.clients.discard(client)
+        self.selector.unregister(client.sock)
+        client.sock.close()
+
+    def add(self, req):
+        """ run an add request, returns its reply """
+        if req['op'] == 'replace':
+            return {'id': self.db.replace_task(req['command'], **req['props'])}
+        if req['op'] == 'unique':
+            task_id, coalesced = self.db.add_unique_task(req['command'], **req['props'])
+            return {'id': task_id, 'coalesced': coalesced}
+        return {'id': self.db.add_task(req['command'], **req['props'])}
+
+    def flush(self, force=False):
+        """ commit queued adds in one transaction once GROUP_COMMIT is over, True if any """
+        if not self.batch or (not force and time.monotonic() < self.flush_at):
+            return False
+
+        batch, self.batch, self.flush_at = self.batch, [], None
+        replies = []
+        try:
+            self.db.begin_transaction(immediate=True)
+            for client, req in batch:
+                # a request the database rejects must not fail the others
+                self.db.query('SAVEPOINT request')
+                try:
+                    replies.append((client, self.add(req)))
+                except sqlite3.OperationalError:
+                    # busy or out of space, nothing the request did
+                    raise
+                except (ValueError, sqlite3.Error) as e:
+                    self.db.query('ROLLBACK TO request')
+                    replies.append((client, {'error': str(e)}))
+                self.db.query('RELEASE request')
+            self.db.commit()
+        except sqlite3.Error as e:
+            self.db.rollback()
+            logger.error(f"API group commit of {len(batch)} tasks failed: {e}")
+            replies = [(client, {'error': str(e)}) for client, _ in batch]
+        else:
+            logger.info(f"API added {len(batch)} tasks.")
+
+        for client, reply in replies:
+            self.reply(client, reply)
+        return True
+
+    def handle(self, client, mask):
+        """ read requests and write replies of a client """
+        if mask & selectors.EVENT_WRITE and client.outbuf:
+            self.send(client)
+        if not mask & selectors.EVENT_READ or client.closed:
+            return
+
+        try:
+            data = client.sock.recv(READ_SIZE)
+        except ConnectionError:
+            data = b''
+        if not data:
+            self.disconnect(client)
+            return
+
+        client.inbuf += data
+        while b'\n' in client.inbuf:
+            line, client.inbuf = client.inbuf.split(b'\n', 1)
+            if line.strip():
+                self.request(client, line)
+
+    def reply(self, client, reply):
+        """ send a reply, the rest is written when the socket is writable """
+        if client.closed:
+            return
+        client.outbuf += json.dumps(reply).encode() + b'\n'
+        self.send(client)
+
+    def request(self, client, line):
+        """ run or queue a single request """
+        try:
+            req = json.loads(line)
+            op = req['op']
+            if op in ('add', 'replace', 'unique'):
+                self.validate(req)
+                if not self.batch:
+                    self.flush_at = time.monotonic() + GROUP_COMMIT
+                self.batch.append((client, req))
+            elif op == 'list':
+                which = req.get('which', 'last')
+                if which not in LISTS:
+                    raise ValueError(f'unknown list {which}')
+                limit = req.get('limit') or (50 if which == 'last' else None)
+                rows, _ = getattr(self.db, f'list_{which}_tasks')(limit, req.get('after_id'))
+                self.reply(client, {'tasks': list(rows)})
+            elif op == 'show':
+                task = self.db.get_task(int(req['id']))
+                self.reply(client, {'task': task} if task else {'error': f"no task {req['id']}"})
+            else:
+                raise ValueError(f'unknown op {op}')
+        except (KeyError, TypeError, ValueError, sqlite3.Error) as e:
+            logger.warning(f"API request {line[:200]} failed: {e!r}")
+            self.reply(client, {'error': f'bad request: {e!r}'})
+
+    def send(self, client):
+        """ write as much of the pending replies as the socket takes """
+        try:
+            sent = client.sock.send(client.outbuf)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.disconnect(client)
+            return
+        client.outbuf = client.outbuf[sent:]
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.outbuf else 0)
+        if events != self.selector.get_key(client.sock).events:
+            self.selector.modify(client.sock, events, self.selector.get_key(client.sock).data)
+
+    def validate(self, req):
+        """ reject commands and task columns add_task cannot take """
+        command = req.get('command')
+        if not isinstance(command, list) or not command \
+                or not all(isinstance(arg, str) for arg in command):
+            raise ValueError('command must be a non empty list of strings')
+        props = req.setdefault('props', {})
+        if not isinstance(props, dict) or not set(props) <= self.columns:
+            raise ValueError(f'unknown task columns: {props}')
+        after = props.pop('after', None) or []
+        if not isinstance(after, list) or not all(isinstance(x, int) for x in after):
+            raise ValueError('after must be a list of task ids')
+        for name, value in props.items():
+            if value is None and name in self.nullable:
+                continue
+            if isinstance(value, bool) or not isinstance(value, PROP_TYPES.get(name, (int, float, str))):
+                raise ValueError(f'{name} cannot be {json.dumps(value)}')
+        if props.get('on_fail', 'skip') not in ON_FAIL:
+            raise ValueError(f"on_fail must be one of {', '.join(ON_FAIL)}")
+        if after:
+            props['after'] = after
@@ -1,166 +1,226 @@
-# pylint: disable=logging-fstring-interpolation, too-many-return-statements
+# pylint: disable=logging-fstring-interpolation, too-many-return-statements, import-outside-toplevel
 # vim: set ts=4 sts=4 sw=4 et tw=0 fileencoding=utf-8:
 """ CLI implementation """
 
 import logging
-import errno
-import fcntl
 import os
-import subprocess
 import sys
 import time
-import sqlite3
 
 from optparse import OptionParser
-from dataclasses import dataclass
-from tsp.database import Database
+from tsp import setup_logging
+from tsp.client import ApiError, request
+from tsp.database import Database, LIST_COLUMNS, SKIPPED, TIMED_OUT, WAITING
+from tsp.spool import print_spool, spool_path
+from tsp.wakeup import wake_daemon
 
 logger = logging.getLogger(__name__)
 
-@dataclass
-class CalcTimes:
-    """ Calculated Times """
-    utime = None
-    stime = None
-    rtime = None
-    def get_elapsed(self, then):
-        """ get elapsed times """
-        now = os.times()
-        self.utime = now[0] - then[0]
-        self.stime = now[1] - then[1]
-        self.rtime = now[4] - then[4]
-        return self
-
-
-@dataclass
-class CmdOutput:
-    """ Command return values """
-    rc = 0
-    stdout = None
-    stderr = None
-    def get_result(self, returncode, output, error):
-        """ use passed params """
-        self.rc = returncode
-        self.stdout = output
-        self.stderr = error
-        return self
-
-
-def do_add(replace, command):
-    """ Add command to database """
+
+def do_add(op, command, props):
+    """
+        Add command, props set task columns like queue
+
+        op is add, replace (pending copies of the command) or unique (unless
+        the command is already pending).  A running daemon adds it for us,
+        sharing one transaction with other clients, without a daemon the task
+        is written to the database.
+
+    """
     if command is None:
         logger.error('Command not specified.')
         sys.exit(1)
 
-    with Database() as db:
-        if replace:
-            task_id = db.replace_task(command)
-        else:
-            task_id = db.add_task(command)
+    try:
+        reply = request({'op': op, 'command': command, 'props': props})
+    except ApiError as e:
+        logger.error(f"Adding the task failed: {e}")
+        sys.exit(1)
+    if reply is None:
+        coalesced = False
+        try:
+            with Database(immediate=True) as db:
+                if op == 'replace':
+                    task_id = db.replace_task(command, **props)
+                elif op == 'unique':
+                    task_id, coalesced = db.add_unique_task(command, **props)
+                else:
+                    task_id = db.add_task(command, **props)
+        except ValueError as e:
+            logger.error(f"Task not added: {e}")
+            sys.exit(1)
+        if not coalesced:
+            wake_daemon()
+    elif 'error' in reply:
+        logger.error(f"Task not added: {reply['error']}")
+        sys.exit(1)
+    else:
+        task_id, coalesced = reply['id'], reply.get('coalesced', False)
+
+    if coalesced:
+        logger.info(f'Task {task_id} is already pending.')
+    else:
+        logger.info(f'Task {task_id} added.')
+
+
+def do_batch(op, source, props, null=False):
+    """ Add a task for each line, or NUL separated entry, of source """
+    if source in (None, '-'):
+        data = sys.stdin.read()
+    else:
+        with open(source, encoding="utf-8") as f:
+            data = f.read()
 
-    logger.info(f'Task {task_id} added.')
+    commands = [cmd.strip() for cmd in data.split('\0' if null else '\n')]
+    commands = [cmd for cmd in commands if cmd]
+    if not commands:
+        print('No tasks added.')
+        return
 
+    try:
+        with Database(immediate=True) as db:
+            first, last = db.add_tasks(commands, op == 'replace', op == 'unique', **props)
+    except ValueError as e:
+        logger.error(f"Tasks not added: {e}")
+        sys.exit(1)
+
+    if first is None:
+        print('All tasks are already pending.')
+        return
 
-def do_list_failed():
+    wake_daemon()
+    logger.info(f'Tasks {first}-{last} added.')
+    print(f'Tasks {first}-{last} added.')
+
+
+def do_list_failed(limit=None, after_id=None, fmt='table'):
     """ list failed commands """
+    if fmt != 'table':
+        return write_tasks('failed', limit, after_id, fmt)
     with Database() as db:
-        tasks, count = db.list_failed_tasks()
+        tasks, count = db.list_failed_tasks(limit, after_id)
 
     print_task_list(tasks, count, 'Failed tasks:', 'No failed tasks.')
 
 
-def do_list_finished():
+def do_list_finished(limit=None, after_id=None, fmt='table'):
     """ list finished commands """
+    if fmt != 'table':
+        return write_tasks('finished', limit, after_id, fmt)
     with Database() as db:
-        tasks, count = db.list_finished_tasks()
+        tasks, count = db.list_finished_tasks(limit, after_id)
 
     print_task_list(tasks, count, 'Finished tasks:', 'No finished tasks.')
 
 
-def do_list_last():
+def do_list_last(limit=None, after_id=None, fmt='table'):
     """ list last command """
+    if fmt != 'table':
+        return write_tasks('last', limit or 50, after_id, fmt)
     with Database() as db:
-        tasks, count = db.list_last_tasks()
+        tasks, count = db.list_last_tasks(limit or 50, after_id)
 
     print_task_list(tasks, count, 'Recent tasks:', 'No recent tasks.')
 
 
-def do_list_pending():
+def do_list_waiting(limit=None, after_id=None, fmt='table'):
+    """ list delayed and recurring commands waiting for their time """
+    if fmt != 'table':
+        return write_tasks('waiting', limit, after_id, fmt)
+    with Database() as db:
+        tasks, count = db.list_waiting_tasks(limit, after_id)
+
+    print_task_list(tasks, count, 'Waiting tasks:', 'No waiting tasks.')
+
+
+def do_list_pending(limit=None, after_id=None, fmt='table'):
     """ list pending command(s) """
+    if fmt != 'table':
+        return write_tasks('pending', limit, after_id, fmt)
     with Database() as db:
-        tasks, count = db.list_pending_tasks()
+        tasks, count = db.list_pending_tasks(limit, after_id)
 
     print_task_list(tasks, count, 'Pending tasks:', 'No pending tasks.')
 
 
 def do_purge():
     """ purge remaining commands """
-    with Database() as db:
+    with Database(immediate=True) as db:
         count = db.purge_pending()
         logger.info(f'Deleted {count} unfinished tasks.')
 
 
-def do_run():
+def do_compact():
+    """ store existing outputs with TS_OUTPUT_CODEC, a batch per transaction """
+    db = Database()
+    after_id, count = 0, 0
+    while after_id is not None:
+        db.begin_transaction(immediate=True)
+        try:
+            after_id, changed = db.compact_step(after_id)
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        count += changed
+
+    db.reclaim()
+    logger.info(f'Compacted the output of {count} tasks.')
+
+
+def do_run(slots=1, queue_slots=None, admission=None, timeout=0, queues=None):
     """
         Run scheduler process
 
-        This should normally be done from a systemd unit
+        This should normally be done from a systemd unit, up to `slots`
+        tasks are run at the same time, queue_slots limits them per queue,
+        the admission rules hold them back while the host is busy and tasks
+        without a timeout of their own are killed after `timeout` seconds.
+        Several daemons may run, for example one for each of `queues`.
 
     """
-    try:
-        lock = os.path.expanduser('~/.cache/tsp.lock')
-        with open(lock, 'w', encoding="utf-8") as flock:
-            fcntl.lockf(flock, fcntl.LOCK_EX | fcntl.LOCK_NB)
-    except IOError as e:
-        if e.errno == errno.EAGAIN:
-            logger.error('tsp daemon is already running', file=sys.stderr)
-            sys.exit(1)
-        else:
-            logger.error(f"do_run - get lock: {e}")
-            raise
-
     db = Database()
 
-    db.reset_running()
-    db.commit()
+    # only the daemon needs these, keep them out of the add and list paths
+    from tsp.admission import Admission
+    from tsp.scheduler import Scheduler
 
-    db.purge_older()
-    db.commit()
+    Scheduler(db, slots, parse_queue_slots(queue_slots), Admission(**(admission or {})),
+              timeout, queues).run()
 
-    while True:
-        task = db.get_next_task()
 
-        if task is None:
-            db.commit()
-            time.sleep(1)
-            continue
+def do_stats(window):
+    """ show throughput and latency over the last window seconds """
+    with Database() as db:
+        stats = db.stats(int(time.time()) - window)
 
-        logger.info(f"Running task {int(task['id'])}: {task['command']}")
+    def seconds(value):
+        return 'n/a' if value is None else f'{value:.2f}s'
 
-        cout = CmdOutput()
-        ctim = CalcTimes()
+    print(f'--- Stats for the last {window}s ---')
+    print(f"finished   : {stats['finished']} ({stats['failed']} failed)")
+    print(f"throughput : {stats['finished'] * 60 / window:.2f} per minute")
+    print(f"pending    : {stats['pending']}")
+    print(f"running    : {stats['running']}")
+    for name in ('wait', 'run'):
+        print(f"{name} time  ".ljust(11) + ': ' + '  '.join(
+            f"p{pct} {seconds(stats[f'{name}_p{pct}'])}" for pct in (50, 95, 99)))
 
-        if task['command'] == 'reload':
-            db.set_finished(int(task['id']), task['command'],
-                            cout.get_result(0, None, None), ctim.get_elapsed(os.times()))
-            db.commit()
-            logger.info('Reloading Tasks.')
-            sys.exit(0)
 
-        db.set_running(int(task['id']))
-        db.commit()
+def do_follow(task_id):
+    """ stream the output of a task while it runs, exits with its result """
+    from tsp.follow import follow
 
-        start_time = os.times()
-        try:
-            output = run_command(task['command'])
-            logger.debug(f"do_run: command: {task['command']}, rc: {output.rc}")
-            db.set_finished(int(task['id']), task['command'], output, ctim.get_elapsed(start_time))
-            logger.info(f"Task {int(task['id'])} finished.")
-        except (ValueError, sqlite3.Error) as e:
-            db.set_failed(int(task['id']), task['command'], str(e), ctim.get_elapsed(start_time))
-            logger.error(f"Task {int(task['id'])} failed: {e}.")
+    try:
+        result = follow(task_id)
+    except KeyboardInterrupt:
+        sys.exit(130)
 
-        db.commit()
+    if result is None:
+        logger.error(f'Task {task_id} not found.')
+        sys.exit(1)
+    # skipped, timed out and tasks that could not start have negative results
+    sys.exit(result if 0 <= result < 256 else 1)
 
 
 def do_show(task_id):
@@ -181,6 +241,26 @@ def do_show(task_id):
 
     print(f"command    : {task['command']}")
 
+    if task['coalesced']:
+        print(f"coalesced  : {task['coalesced']} more adds")
+
+    if task['not_before']:
+        print(f"not before : {time.strftime(date_fmt, time.localtime(task['not_before']))}")
+    if task['every']:
+        print(f"every      : {task['every']}s")
+    if task['timeout']:
+        print(f"timeout    : {task['timeout']}s")
+    if task['retries']:
+        backoff = f" (backoff {task['backoff']}s)" if task['backoff'] else ''
+        print(f"retries    : {task['attempts']} of {task['retries']}{backoff}")
+        for attempt in task['history']:
+            print(f"attempt {attempt['attempt']:<3}: result {attempt['result']}, "
+                  f"{time.strftime(date_fmt, time.localtime(attempt['run_at']))}, "
+                  f"{attempt['time_r']}s")
+
+    if task['after']:
+        print(f"after      : {', '.join(str(x) for x in task['after'])} (on failure: {task['on_fail']})")
+
     print(f"result     : {task['result']}"
         if task['result'] is not None else 'result     : none')
 
@@ -190,34 +270,27 @@ def do_show(task_id):
         print(f"user time  : {task['time_u']}")
     if task['time_s']:
         print(f"sys time   : {task['time_s']}")
+    if task['max_rss'] is not None:
+        print(f"max rss    : {task['max_rss']} KiB")
+        print(f"block io   : {task['blk_in']} in / {task['blk_out']} out")
+        print(f"ctx switch : {task['ctx_vol']} voluntary / {task['ctx_invol']} involuntary")
+    if task['io_read'] is not None:
+        print(f"disk io    : {task['io_read']} bytes read / {task['io_write']} bytes written")
 
-    if not task['stdout']:
+    has_stdout = os.path.exists(spool_path(task['id'], 'stdout')) or task['stdout']
+    has_stderr = os.path.exists(spool_path(task['id'], 'stderr')) or task['stderr']
+
+    if not has_stdout:
         print('stdout     : empty')
 
-    if not task['stderr']:
+    if not has_stderr:
         print('stderr     : empty')
 
-    if task['stdout']:
-        print(f"\n--- stdout ---\n\n{str(task['stdout']).rstrip()}\n")
-
-    if task['stderr']:
-        print(f"\n--- stderr ---\n\n{str(task['stderr']).rstrip()}\n")
-
-
-def find_executable(command):
-    """ find command executeable """
-    if os.path.exists(command):
-        return command
-
-    base = os.path.basename(command)
-
-    for folder in os.getenv('PATH').split(os.path.pathsep):
-        exe = os.path.join(folder, base)
-        if os.path.exists(exe):
-            return exe
+    if has_stdout:
+        print_output(task, 'stdout')
 
-    logger.error(f'command {base} not found')
-    raise RuntimeError(f'command {base} not found')
+    if has_stderr:
+        print_output(task, 'stderr')
 
 
 def main():
@@ -236,11 +309,54 @@ def main():
     #                   help="add a task to the queue")
     parser.add_option("--replace",
                       action="store_true", dest="replace",
-                      help="replace a task in the queue")
+                      help="replace pending copies of the task")
+    parser.add_option("--unique",
+                      action="store_true", dest="unique",
+                      help="don't add the task if it is already pending")
+    parser.add_option("--batch",
+                      action="store_true", dest="batch",
+                      help="add a task for each line of FILE, or of stdin")
+    parser.add_option("-0", "--null",
+                      action="store_true", dest="null",
+                      help="batch commands are separated by NUL, not newline")
+    parser.add_option("-Q", "--queue",
+                      action="store",
+                      help="add the task to a named queue, with --run only run tasks of"
+                           " these comma separated queues")
+    parser.add_option("--after",
+                      action="store",
+                      help="run the task once the tasks with these comma separated ids ended")
+    parser.add_option("--on-fail",
+                      action="store", dest="on_fail", choices=['skip', 'run'],
+                      help="skip (default) or run the task if a task it runs after failed")
+    parser.add_option("--at",
+                      action="store",
+                      help="don't start the task before AT, like 18:30 or '2024-05-01 18:30'")
+    parser.add_option("--in",
+                      action="store", dest="delay",
+                      help="don't start the task before IN from now, like 90, 10m, 2h or 1d")
+    parser.add_option("--every",
+                      action="store",
+                      help="run the task again EVERY period, like 15m, counted from its start time")
+    parser.add_option("--timeout",
+                      action="store", type="float",
+                      help="kill the task after TIMEOUT seconds, with --run the default for all tasks")
+    parser.add_option("--retries",
+                      action="store", type="int",
+                      help="run the task again up to RETRIES times while it fails")
+    parser.add_option("--backoff",
+                      action="store", type="float",
+                      help="seconds before the first retry, doubled for each further one")
+    parser.add_option("--priority",
+                      action="store", type="int",
+                      help="run the task before lower priority ones of its queue")
     parser.add_option("-s", "--show",
                       action="store", type="int",
                       dest="task_id",
                       help="list task entry")
+    parser.add_option("-F", "--follow",
+                      action="store", type="int",
+                      help="stream the output of a task until it ends, exit with its result")
     parser.add_option("-p", "--pending",
                       action='store_true',
                       help="list pending tasks")
@@ -250,37 +366,239 @@ def main():
     parser.add_option("-f", "--failed",
                       action='store_true',
                       help="list failed tasks")
+    parser.add_option("-w", "--waiting",
+                      action='store_true',
+                      help="list delayed and recurring tasks waiting for their time")
+    parser.add_option("--limit",
+                      action="store", type="int",
+                      help="list at most LIMIT tasks")
+    parser.add_option("--after-id",
+                      action="store", type="int", dest="after_id",
+                      help="list tasks with an id above AFTER_ID")
+    parser.add_option("--format",
+                      action="store", default="table", choices=['table', 'json', 'jsonl', 'tsv'],
+                      help="list tasks as a table (default), a JSON array, JSON lines or TSV")
+    parser.add_option("--stats",
+                      action='store_true',
+                      help="show throughput and wait/run time percentiles")
+    parser.add_option("--window",
+                      action="store", type="int", default=86400,
+                      help="seconds covered by --stats")
     parser.add_option("-d", "--purge",
                       action='store_true',
-                      help="delete pending tasks")
+                      help="delete pending and waiting tasks")
+    parser.add_option("--compact",
+                      action='store_true',
+                      help="store the output of finished tasks with TS_OUTPUT_CODEC")
     parser.add_option("--run",
                       action='store_true',
                       help="run the daemon")
+    parser.add_option("--slots",
+                      action="store", type="int",
+                      default=int(os.getenv('TS_SLOTS', '1')),
+                      help="number of tasks the daemon runs at once")
+    parser.add_option("--queue-slots",
+                      action="store", dest="queue_slots",
+                      default=os.getenv('TS_QUEUE_SLOTS'),
+                      help="per queue limits of running tasks, like net=4,cpu=1")
+    parser.add_option("--max-load",
+                      action="store", type="float", dest="max_load",
+                      default=float(os.getenv('TS_MAX_LOAD', '0')),
+                      help="hold tasks while the 1 minute load average is above this")
+    parser.add_option("--min-memory",
+                      action="store", type="int", dest="min_memory",
+                      default=int(os.getenv('TS_MIN_MEMORY', '0')),
+                      help="hold tasks while less MiB of memory are available")
+    parser.add_option("--max-pressure",
+                      action="store", type="float", dest="max_pressure",
+                      default=float(os.getenv('TS_MAX_PRESSURE', '0')),
+                      help="hold tasks while CPU or IO pressure (PSI avg10) is above this")
 
     (opts, args) = parser.parse_args()
+    setup_logging()
     if opts.verbose:
         logger.setLevel("DEBUG")
 
     logger.debug(f"Options: {opts}, Args: {args}")
 
     if opts.pending:
-        return do_list_pending()
+        return do_list_pending(opts.limit, opts.after_id, opts.format)
     if opts.finished:
-        return do_list_finished()
+        return do_list_finished(opts.limit, opts.after_id, opts.format)
     if opts.failed:
-        return do_list_failed()
+        return do_list_failed(opts.limit, opts.after_id, opts.format)
+    if opts.waiting:
+        return do_list_waiting(opts.limit, opts.after_id, opts.format)
     if opts.purge:
         return do_purge()
+    if opts.compact:
+        return do_compact()
+    if opts.stats:
+        return do_stats(opts.window)
     if opts.run:
-        return do_run()
+        return do_run(opts.slots, opts.queue_slots,
+                      {'max_load': opts.max_load, 'min_memory': opts.min_memory,
+                       'max_pressure': opts.max_pressure},
+                      opts.timeout or float(os.getenv('TS_TIMEOUT', '0')),
+                      opts.queue.split(',') if opts.queue else None)
+    if opts.follow:
+        return do_follow(opts.follow)
     if opts.task_id:
         return do_show(opts.task_id)
+    props = {}
+    if opts.queue:
+        props['queue'] = opts.queue
+    if opts.priority:
+        props['priority'] = opts.priority
+    if opts.after:
+        try:
+            props['after'] = [int(x) for x in opts.after.split(',')]
+        except ValueError:
+            logger.error(f'Invalid task ids: {opts.after}')
+            sys.exit(1)
+    if opts.on_fail:
+        props['on_fail'] = opts.on_fail
+    if opts.timeout:
+        props['timeout'] = opts.timeout
+    if opts.retries:
+        props['retries'] = opts.retries
+    if opts.backoff:
+        props['backoff'] = opts.backoff
+    try:
+        if opts.at:
+            props['not_before'] = parse_time(opts.at)
+        if opts.delay:
+            props['not_before'] = int(time.time()) + parse_duration(opts.delay)
+        if opts.every:
+            props['every'] = parse_duration(opts.every)
+    except ValueError as e:
+        logger.error(f'{e}')
+        sys.exit(1)
+
+    if opts.replace and opts.unique:
+        logger.error('--replace and --unique exclude each other.')
+        sys.exit(1)
+    op = 'replace' if opts.replace else 'unique' if opts.unique else 'add'
+
+    if opts.batch:
+        return do_batch(op, args[0] if args else None, props, opts.null)
 
     # add a task
     if len(args) > 0:
-        return do_add(opts.replace, args)
+        return do_add(op, args, props)
+
+    return do_list_last(opts.limit, opts.after_id, opts.format)
+
+
+def parse_duration(spec):
+    """ seconds of 90, 90s, 10m, 2h or 1d """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    spec = spec.strip()
+    try:
+        if spec[-1:] in units:
+            seconds = int(float(spec[:-1]) * units[spec[-1]])
+        else:
+            seconds = int(float(spec))
+    except ValueError:
+        seconds = 0
+    if seconds <= 0:
+        raise ValueError(f'Invalid duration: {spec}')
+    return seconds
+
+
+def parse_time(spec):
+    """ seconds since the epoch of a local date and/or time, a time alone is the next one to come """
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M',
+                '%Y-%m-%d'):
+        try:
+            return int(time.mktime(time.strptime(spec, fmt)))
+        except ValueError:
+            pass
+
+    now = time.localtime()
+    for fmt in ('%H:%M:%S', '%H:%M'):
+        try:
+            parsed = time.strptime(spec, fmt)
+        except ValueError:
+            continue
+        due = int(time.mktime(now[:3] + parsed[3:6] + (0, 0, -1)))
+        # 'tomorrow' by the calendar, so that DST changes keep the time of day
+        return due if due > time.time() else int(time.mktime(
+            now[:2] + (now[2] + 1,) + parsed[3:6] + (0, 0, -1)))
+
+    raise ValueError(f'Invalid time: {spec}')
+
+
+def parse_queue_slots(spec):
+    """ turn net=4,cpu=1 into a dict """
+    limits = {}
+    for item in (spec or '').split(','):
+        if not item.strip():
+            continue
+        name, _, count = item.partition('=')
+        try:
+            limits[name.strip()] = int(count)
+        except ValueError:
+            logger.error(f'Invalid queue slots: {item}')
+            sys.exit(1)
+    return limits
 
-    return do_list_last()
+
+def task_state(task):
+    """ what the lists show as the state of a task """
+    if task['status'] == 0:
+        return 'blocked' if task['blocked'] else 'pending'
+    if task['status'] == WAITING:
+        return 'waiting'
+    if task['status'] == 1:
+        return 'running'
+    if task['status'] == 2:
+        return {SKIPPED: 'skipped', TIMED_OUT: 'timed out'}.get(task['result'], 'finished')
+    return 'failed'
+
+
+def tsv_field(value):
+    """ a value on one line without tabs, None as an empty field """
+    if value is None:
+        return ''
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+def write_tasks(which, limit, after_id, fmt):
+    """ write a task list for scripts, a row at a time as it is read from the database """
+    import json
+    out = sys.stdout
+    try:
+        if fmt == 'json':
+            out.write('[')
+        elif fmt == 'tsv':
+            out.write('\t'.join(LIST_COLUMNS.split(', ') + ['state']) + '\n')
+
+        with Database() as db:
+            for i, task in enumerate(db.iter_tasks(which, limit, after_id)):
+                task['state'] = task_state(task)
+                if fmt == 'tsv':
+                    out.write('\t'.join(tsv_field(value) for value in task.values()) + '\n')
+                else:
+                    out.write(('' if fmt == 'jsonl' or i == 0 else ',') + json.dumps(task) + '\n')
+
+        if fmt == 'json':
+            out.write(']\n')
+        out.flush()
+    except BrokenPipeError:
+        # the reader, say head, has seen enough, and the interpreter must not
+        # fail again flushing stdout at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), out.fileno())
+        sys.exit(1)
+
+
+def print_output(task, name):
+    """ print task output, streaming it from the spool file if there is one """
+    print(f"\n--- {name} ---\n")
+    if print_spool(task['id'], name):
+        print()
+    else:
+        print(f"{str(task[name]).rstrip()}\n")
 
 
 def print_task_list(tasks, count, header, no_header):
@@ -314,34 +632,17 @@ def print_task_list(tasks, count, header, no_header):
 
         # Original output from tsn
         # ID   State      Output               E-Level  Times(r/u/s)   Command [run=0/4]
-        print("ID".ljust(5, " "), "State" .ljust(10, " "), "E-Level".ljust(8, " "),
-            "Times(r/u/s)".ljust(25, " "), "Command".ljust(100," "))
+        print("ID".ljust(5, " "), "Queue".ljust(10, " "), "State" .ljust(10, " "),
+            "E-Level".ljust(8, " "), "Times(r/u/s)".ljust(25, " "), "Command".ljust(100," "))
 
         for t in tasks:
             logger.debug(f"Task entry: {t}")
-            if t['status'] == 0:
-                state = 'pending'
-            elif t['status'] == 1:
-                state = 'running'
-            elif t['status'] == 2:
-                state = 'finished'
-            else:
-                state = 'failed'
+            state = task_state(t)
 
             if not t['time_r'] is None:
                 times = f"{t['time_r']}/{t['time_u']}/{t['time_s']}"
             else:
                 times = "None"
-            print(str(t['id']).ljust(5, " "), state.ljust(10, " "), str(t['result']).ljust(8, " "),
-                times.ljust(25, " "), t['command'].ljust(100," "))
-
-
-def run_command(command):
-    """ run command """
-    command = command.split()
-    command[0] = find_executable(command[0])
-    logger.debug(f"run_command#1 - command: {command}")
-    cout = CmdOutput()
-    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as p:
-        logger.debug(f"run_command#2 - rc: {p.returncode}")
-        return cout.get_result(p.returncode, *(p.communicate()))
+            print(str(t['id']).ljust(5, " "), t['queue'].ljust(10, " "), state.ljust(10, " "),
+                str(t['result']).ljust(8, " "), times.ljust(25, " "), t['command'].ljust(100," "))
+
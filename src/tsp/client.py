@@ -0,0 +1,62 @@
+# pylint: disable=logging-fstring-interpolation
+# vim: set ts=4 sts=4 sw=4 et tw=0:
+""" Client side of the daemon's API, kept small as every tsp command imports it """
+
+import logging
+import os
+import socket
+
+from tsp import database
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['ApiError', 'api_path', 'request']
+
+# seconds a client waits for the daemon to reply
+API_TIMEOUT = database.BUSY_TIMEOUT / 1000 + 5
+READ_SIZE = 65536
+
+
+def api_path():
+    """ stream socket the daemon serves, next to the database """
+    return os.path.join(os.path.dirname(database.DB_PATH), 'tsp.sock')
+
+
+class ApiError(Exception):
+    """ The daemon could not be asked, or did not answer """
+
+
+def request(payload):
+    """
+        send one request to the daemon, returns its reply, None if no daemon
+        listens.  Raises ApiError if it cannot be reached for another reason,
+        or fails to reply once the request was sent, as it may have run it.
+
+    """
+    import json # pylint: disable=import-outside-toplevel
+    path = api_path()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(API_TIMEOUT)
+        try:
+            sock.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            logger.debug(f"request: {e}")
+            return None
+        except OSError as e:
+            raise ApiError(f"cannot connect to the daemon at {path}: {e}") from e
+
+        try:
+            sock.sendall(json.dumps(payload).encode() + b'\n')
+            data = b''
+            while not data.endswith(b'\n'):
+                chunk = sock.recv(READ_SIZE)
+                if not chunk:
+                    raise ConnectionError('it closed the connection')
+                data += chunk
+        except TimeoutError as e:
+            raise ApiError(f"the daemon did not reply within {API_TIMEOUT:.0f}s,"
+                           " the request may still have been carried out") from e
+        except OSError as e:
+            raise ApiError(f"lost the daemon ({e}), the request may have been carried out") from e
+
+    return json.loads(data)
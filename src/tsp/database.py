@@ -5,9 +5,10 @@
 import logging
 import os
 import time
+import zlib
 
 from sqlite3 import dbapi2 as sqlite
-from tsp.email import Email
+from tsp.spool import remove_spools, spool_size
 
 logger = logging.getLogger(__name__)
 
@@ -19,10 +20,236 @@ BOOTSTRAP = [
         finished_at INTEGER, command TEXT, status INTEGER, result INTEGER, stdout TEXT,\
         stderr TEXT, time_r REAL, time_u REAL, time_s REAL)',
     'CREATE INDEX IF NOT EXISTS IDX_tasks_command ON tasks (command)',
+    'CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY, queued_at INTEGER,\
+        subject TEXT, body TEXT, failed INTEGER, attempts INTEGER DEFAULT 0,\
+        next_try_at INTEGER DEFAULT 0)',
 ]
 
+# schema changes, PRAGMA user_version counts those applied
+MIGRATIONS = [
+    # 1: status aware indexes for dispatch, the list commands and purging
+    [
+        'CREATE INDEX IF NOT EXISTS IDX_tasks_pending ON tasks (id) WHERE status = 0',
+        'CREATE INDEX IF NOT EXISTS IDX_tasks_finished ON tasks (id) WHERE status = 2 AND result = 0',
+        'CREATE INDEX IF NOT EXISTS IDX_tasks_failed ON tasks (id) WHERE status = 2 AND result <> 0',
+        'CREATE INDEX IF NOT EXISTS IDX_tasks_added_at ON tasks (added_at)',
+    ],
+    # 2: move output out of tasks, which keeps only the (now unused) columns
+    [
+        'CREATE TABLE IF NOT EXISTS outputs (task_id INTEGER PRIMARY KEY, stdout TEXT, stderr TEXT)',
+        'INSERT OR REPLACE INTO outputs (task_id, stdout, stderr) SELECT id, stdout, stderr\
+            FROM tasks WHERE stdout IS NOT NULL OR stderr IS NOT NULL',
+        'UPDATE tasks SET stdout = NULL, stderr = NULL WHERE stdout IS NOT NULL OR stderr IS NOT NULL',
+        'CREATE TRIGGER IF NOT EXISTS TRG_tasks_outputs AFTER DELETE ON tasks\
+            BEGIN DELETE FROM outputs WHERE task_id = old.id; END',
+    ],
+    # 3: WAL journal, switched on by migrate() as it cannot be done in a transaction
+    [],
+    # 4: output sizes and finished-by-age index for retention, migrate() also sets
+    #    auto_vacuum = INCREMENTAL
+    [
+        'ALTER TABLE outputs ADD COLUMN size INTEGER DEFAULT 0',
+        'UPDATE outputs SET size = coalesce(length(CAST(stdout AS BLOB)), 0)\
+            + coalesce(length(CAST(stderr AS BLOB)), 0)',
+        'CREATE INDEX IF NOT EXISTS IDX_outputs_size ON outputs (task_id, size)',
+        'CREATE INDEX IF NOT EXISTS IDX_tasks_done ON tasks (added_at) WHERE status = 2',
+    ],
+    # 5: named queues and priorities
+    [
+        "ALTER TABLE tasks ADD COLUMN queue TEXT NOT NULL DEFAULT 'default'",
+        'ALTER TABLE tasks ADD COLUMN priority INTEGER NOT NULL DEFAULT 0',
+        'CREATE INDEX IF NOT EXISTS IDX_tasks_queue ON tasks (queue, priority DESC, id)\
+            WHERE status = 0',
+    ],
+    # 6: resource usage, max_rss in KiB, blk_* in blocks, io_* in bytes
+    [
+        'ALTER TABLE tasks ADD COLUMN max_rss INTEGER',
+        'ALTER TABLE tasks ADD COLUMN blk_in INTEGER',
+        'ALTER TABLE tasks ADD COLUMN blk_out INTEGER',
+        'ALTER TABLE tasks ADD COLUMN ctx_vol INTEGER',
+        'ALTER TABLE tasks ADD COLUMN ctx_invol INTEGER',
+        'ALTER TABLE tasks ADD COLUMN io_read INTEGER',
+        'ALTER TABLE tasks ADD COLUMN io_write INTEGER',
+    ],
+    # 7: covering index for stats over a window of finished tasks, status included so
+    #    that SQLite needs no table lookups
+    [
+        'CREATE INDEX IF NOT EXISTS IDX_tasks_stats ON tasks (finished_at, added_at, run_at,\
+            time_r, result, status) WHERE status = 2',
+    ],
+    # 8: running tasks, counted by stats
+    [
+        'CREATE INDEX IF NOT EXISTS IDX_tasks_running ON tasks (id) WHERE status = 1',
+    ],
+    # 9: command hashes, to find pending copies of a command, and how many adds
+    #    --unique folded into a task.  Plain adds may still queue a command twice,
+    #    so the index cannot be UNIQUE, --unique looks up and inserts in one
+    #    immediate transaction instead
+    [
+        'ALTER TABLE tasks ADD COLUMN cmd_hash INTEGER',
+        'ALTER TABLE tasks ADD COLUMN coalesced INTEGER NOT NULL DEFAULT 0',
+        'UPDATE tasks SET cmd_hash = cmd_hash(command) WHERE status = 0',
+        'CREATE INDEX IF NOT EXISTS IDX_tasks_hash ON tasks (cmd_hash) WHERE status = 0',
+    ],
+    # 10: dependencies, blocked counts the unfinished parents of a pending task and
+    #     on_fail says whether it is skipped or run when one of them fails.  Only
+    #     unblocked tasks are ready to run.  Deleting an unfinished parent releases
+    #     its dependents
+    [
+        'CREATE TABLE IF NOT EXISTS deps (task_id INTEGER NOT NULL, parent_id INTEGER NOT NULL,\
+            PRIMARY KEY (task_id, parent_id)) WITHOUT ROWID',
+        'CREATE INDEX IF NOT EXISTS IDX_deps_parent ON deps (parent_id)',
+        'ALTER TABLE tasks ADD COLUMN blocked INTEGER NOT NULL DEFAULT 0',
+        "ALTER TABLE tasks ADD COLUMN on_fail TEXT NOT NULL DEFAULT 'skip'",
+        'DROP INDEX IF EXISTS IDX_tasks_queue',
+        'CREATE INDEX IF NOT EXISTS IDX_tasks_ready ON tasks (queue, priority DESC, id)\
+            WHERE status = 0 AND blocked = 0',
+        'CREATE TRIGGER IF NOT EXISTS TRG_tasks_deps AFTER DELETE ON tasks BEGIN\
+            UPDATE tasks SET blocked = blocked - 1 WHERE old.status <> 2\
+                AND id IN (SELECT task_id FROM deps WHERE parent_id = old.id);\
+            DELETE FROM deps WHERE task_id = old.id OR parent_id = old.id; END',
+    ],
+    # 11: seconds a task may run, NULL for the daemon's default
+    [
+        'ALTER TABLE tasks ADD COLUMN timeout REAL',
+    ],
+    # 12: delayed and recurring tasks, waiting ones (status 4) become pending once
+    #     not_before has passed, every is the number of seconds between runs
+    [
+        'ALTER TABLE tasks ADD COLUMN not_before INTEGER',
+        'ALTER TABLE tasks ADD COLUMN every INTEGER',
+        'CREATE INDEX IF NOT EXISTS IDX_tasks_waiting ON tasks (not_before) WHERE status = 4',
+    ],
+    # 13: leases, the daemon running a task renews lease_until until it ends, tasks
+    #     whose lease expired are requeued
+    [
+        'ALTER TABLE tasks ADD COLUMN owner TEXT',
+        'ALTER TABLE tasks ADD COLUMN lease_until INTEGER',
+        'CREATE INDEX IF NOT EXISTS IDX_tasks_leases ON tasks (lease_until) WHERE status = 1',
+    ],
+    # 14: retries, a failed task waits (status 4) for its next attempt while attempts
+    #     is below retries, backoff is the delay before the first retry.  Each attempt
+    #     of a task with retries is kept
+    [
+        'ALTER TABLE tasks ADD COLUMN retries INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE tasks ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE tasks ADD COLUMN backoff REAL',
+        'CREATE TABLE IF NOT EXISTS attempts (task_id INTEGER NOT NULL, attempt INTEGER NOT NULL,\
+            run_at INTEGER, finished_at INTEGER, result INTEGER, time_r REAL,\
+            PRIMARY KEY (task_id, attempt)) WITHOUT ROWID',
+        'CREATE TRIGGER IF NOT EXISTS TRG_tasks_attempts AFTER DELETE ON tasks\
+            BEGIN DELETE FROM attempts WHERE task_id = old.id; END',
+    ],
+    # 15: waiting tasks are replaced, coalesced and purged like pending ones
+    [
+        'UPDATE tasks SET cmd_hash = cmd_hash(command) WHERE status = 4 AND cmd_hash IS NULL',
+        'DROP INDEX IF EXISTS IDX_tasks_hash',
+        'CREATE INDEX IF NOT EXISTS IDX_tasks_hash ON tasks (cmd_hash, status)\
+            WHERE status IN (0, 4)',
+    ],
+    # 16: the waiting list, like the other lists, in id order
+    [
+        'CREATE INDEX IF NOT EXISTS IDX_tasks_waiting_list ON tasks (id) WHERE status = 4',
+    ],
+    # 17: the not_before a task was added with, set aside while retries move it
+    [
+        'ALTER TABLE tasks ADD COLUMN scheduled_at INTEGER',
+    ],
+]
+
+# retention of finished tasks, by age and optionally by count and output bytes
+KEEP_DAYS = float(os.getenv('TS_KEEP_DAYS', '30'))
+KEEP_TASKS = int(os.getenv('TS_KEEP_TASKS', '0'))
+KEEP_BYTES = int(os.getenv('TS_KEEP_BYTES', '0'))
+PURGE_BATCH = 500
+
+# what the list commands show, output is only loaded by get_task
+LIST_COLUMNS = 'id, queue, status, blocked, result, time_r, time_u, time_s, command'
+# conditions of the task lists, by name
+LISTS = {
+    'pending': ['status = 0'],
+    'waiting': ['status = 4'],
+    'failed': ['status = 2', 'result <> 0'],
+    'finished': ['status = 2', 'result = 0'],
+    'last': [],
+}
+# rows a streaming cursor fetches at a time
+ITER_BATCH = 256
+
+# result of tasks skipped because a task they run after failed
+SKIPPED = -2
+# result of tasks killed because they ran longer than their timeout
+TIMED_OUT = -3
+
+# status of tasks that must not start before their not_before time
+WAITING = 4
+
+# seconds a claimed task stays leased to its daemon without a renewal
+LEASE = int(os.getenv('TS_LEASE', '60'))
+# single statement claims, UPDATE ... RETURNING needs SQLite 3.35
+CLAIM_RETURNING = sqlite.sqlite_version_info >= (3, 35, 0)
+
+# only queue notifications about failures
+MAIL_FAILURES_ONLY = os.getenv('TS_MAIL_FAILURES_ONLY', '') not in ('', '0')
+
+
+# codec of stored outputs: zlib, lzma or none, outputs shorter than COMPRESS_MIN bytes
+# or that don't shrink stay text, compressed ones are BLOBs starting with their codec's marker
+OUTPUT_CODEC = os.getenv('TS_OUTPUT_CODEC', 'zlib')
+COMPRESS_MIN = int(os.getenv('TS_COMPRESS_MIN', '256'))
+CODECS = {'zlib': b'z', 'lzma': b'x'}
+
+
+def compress(text, codec=OUTPUT_CODEC):
+    """ stored form of an output, compressed with codec if that pays """
+    if text is None or codec not in CODECS:
+        return text
+
+    data = text.encode(errors='replace')
+    if len(data) < COMPRESS_MIN:
+        return text
+    if codec == 'lzma':
+        import lzma # pylint: disable=import-outside-toplevel
+        packed = CODECS[codec] + lzma.compress(data)
+    else:
+        packed = CODECS[codec] + zlib.compress(data)
+    return packed if len(packed) < len(data) else text
+
+
+def decompress(value):
+    """ text of a stored output """
+    if not isinstance(value, bytes):
+        return value
+
+    marker, data = value[:1], value[1:]
+    if marker == CODECS['lzma']:
+        import lzma # pylint: disable=import-outside-toplevel
+        data = lzma.decompress(data)
+    elif marker == CODECS['zlib']:
+        data = zlib.decompress(data)
+    return data.decode(errors='replace')
+
+
+def stored_size(value):
+    """ bytes an output takes in the database """
+    if value is None:
+        return 0
+    return len(value) if isinstance(value, bytes) else len(value.encode(errors='replace'))
+
+
+def command_hash(cmd_str):
+    """ cmd_hash of a command string, it only narrows the search, commands are still compared """
+    return zlib.crc32(cmd_str.encode())
+
 DB_PATH = os.path.expanduser('~/.local/share/tsp/tasks.db')
 
+# milliseconds SQLite waits for a lock, then statements outside a transaction are retried
+BUSY_TIMEOUT = int(os.getenv('TS_BUSY_TIMEOUT', '10000'))
+BUSY_RETRIES = 5
+# set on every connection, journal_mode = WAL is stored in the file by migrate()
+CONNECT_PRAGMAS = f"PRAGMA busy_timeout = {BUSY_TIMEOUT};\
+    PRAGMA synchronous = {os.getenv('TS_SYNCHRONOUS', 'NORMAL')};"
+
 
 class DAL:
     """ Database Abstraction Layer """
@@ -30,7 +257,7 @@ class DAL:
         self.rollback()
 
     def __enter__(self):
-        self.begin_transaction()
+        self.begin_transaction(self.immediate)
         return self
 
     def __exit__(self, _type, _value, tb):
@@ -39,19 +266,26 @@ class DAL:
         else:
             self.rollback()
 
-    def __init__(self):
+    def __init__(self, immediate=False):
         self.filename = DB_PATH
+        self.immediate = immediate
+        # called with the seconds each statement took
+        self.observer = None
         self.db = self.connect()
         self.bootstrap()
 
-    def begin_transaction(self):
-        """ begin a transaction """
-        self.query('BEGIN TRANSACTION')
+    def begin_transaction(self, immediate=False):
+        """ begin a transaction, taking the write lock at once if immediate """
+        self.query('BEGIN IMMEDIATE TRANSACTION' if immediate else 'BEGIN TRANSACTION')
 
     def bootstrap(self):
-        """ bootstrap database """
+        """ bootstrap database, unless its schema is already up to date """
+        if self.pragma('user_version') == len(MIGRATIONS):
+            return
+
         for query in BOOTSTRAP:
             self.query(query)
+        self.migrate()
 
     def commit(self):
         """ commit update(s) """
@@ -59,13 +293,14 @@ class DAL:
 
     def connect(self):
         """ connect to database """
-        folder = os.path.dirname(self.filename)
-        if not os.path.exists(folder):
-            os.makedirs(folder)
+        # daemons started together may both create it
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
 
-        db = sqlite.connect(self.filename)
+        db = sqlite.connect(self.filename, timeout=BUSY_TIMEOUT / 1000)
         db.isolation_level = None
         db.text_factory = str
+        db.create_function('cmd_hash', 1, command_hash, deterministic=True)
+        db.executescript(CONNECT_PRAGMAS)
         return db
 
     def insert(self, table, props):
@@ -82,21 +317,100 @@ class DAL:
         query = f"INSERT INTO {table} ({', '.join(fields)}) VALUES ({', '.join(marks)})"
         return self.query(query, params)
 
+    def insert_many(self, table, rows):
+        """ insert rows with the same fields using a single statement """
+        fields = list(rows[0].keys())
+        query = f"INSERT INTO {table} ({', '.join('`' + k + '`' for k in fields)})\
+            VALUES ({', '.join('?' for _ in fields)})"
+
+        cur = self.db.cursor()
+        try:
+            cur.executemany(query, [[row[k] for k in fields] for row in rows])
+            return cur.rowcount
+        except:
+            self.log_exception(f'failed SQL statement: {query}, rows: {len(rows)}')
+            raise
+        finally:
+            cur.close()
+
+    def iterate(self, query, params=None):
+        """ rows of a SELECT as dicts, fetched in batches so that memory use stays flat """
+        cur = self.db.cursor()
+        try:
+            cur.execute(query, params or [])
+            names = [desc[0] for desc in cur.description]
+            while rows := cur.fetchmany(ITER_BATCH):
+                for row in rows:
+                    yield dict(zip(names, row))
+        # not GeneratorExit, readers may stop early
+        except sqlite.Error:
+            self.log_exception(f'failed SQL statement: {query}, params: {params}')
+            raise
+        finally:
+            cur.close()
+
     def log_exception(self, msg):
         """ log exception """
         logger.error(msg)
 
+    def migrate(self):
+        """ apply pending migrations, each in its own transaction """
+        if self.pragma('user_version') < len(MIGRATIONS):
+            self.pragma('journal_mode', 'WAL')
+            if self.pragma('auto_vacuum') != 2:
+                # only takes effect on an existing database once it is rebuilt
+                self.pragma('auto_vacuum', 'INCREMENTAL')
+                self.query('VACUUM')
+
+        while self.pragma('user_version') < len(MIGRATIONS):
+            self.begin_transaction(immediate=True)
+            try:
+                # another process may have migrated while we waited for the lock
+                version = self.pragma('user_version')
+                if version < len(MIGRATIONS):
+                    logger.info(f"Migrating database to version {version + 1}")
+                    for query in MIGRATIONS[version]:
+                        self.query(query)
+                    self.pragma('user_version', version + 1)
+                self.commit()
+            except:
+                self.rollback()
+                raise
+
+    def pragma(self, name, value=None):
+        """ read or set a pragma """
+        if value is None:
+            return self.db.execute(f'PRAGMA {name}').fetchone()[0]
+        return self.db.execute(f'PRAGMA {name} = {value}').fetchall()
+
     def query(self, query, params=None):
-        """ query database """
+        """ query database, retrying while it is locked unless inside a transaction """
+        delay = 0.05
+        for _ in range(BUSY_RETRIES):
+            try:
+                return self.execute(query, params)
+            except sqlite.OperationalError as e:
+                if self.db.in_transaction or not str(e).startswith(('database is locked',
+                                                                   'database is busy')):
+                    raise
+                logger.warning(f"Database busy, retrying in {delay}s: {query}")
+                time.sleep(delay)
+                delay *= 2
+
+        return self.execute(query, params)
+
+    def execute(self, query, params=None):
+        """ run a single statement """
         cur = self.db.cursor()
 
         args = [query]
         if params is not None:
             args.append(params)
 
+        start = time.perf_counter()
         try:
             cur.execute(*args)
-            if query.startswith('SELECT '):
+            if query.startswith('SELECT ') or ' RETURNING ' in query:
                 rows = cur.fetchall()
                 names = [desc[0] for desc in cur.description]
                 return [dict(zip(names, row)) for row in rows]
@@ -108,6 +422,13 @@ class DAL:
             raise
         finally:
             cur.close()
+            if self.observer:
+                self.observer(time.perf_counter() - start)
+
+    def reclaim(self):
+        """ return free pages to the file system """
+        # the statement frees a page per step, so it has to be run to completion
+        self.db.execute('PRAGMA incremental_vacuum').fetchall()
 
     def rollback(self):
         """ rollback changes """
@@ -137,62 +458,316 @@ class DAL:
 class Database(DAL):
     """ Database methods """
 
-    def add_task(self, command):
-        """ add task """
+    def add_attempt(self, task_id):
+        """ keep the result of the attempt a task just ended """
+        return self.query('INSERT OR REPLACE INTO attempts (task_id, attempt, run_at, finished_at,\
+            result, time_r) SELECT id, attempts + 1, run_at, finished_at, result, time_r\
+            FROM tasks WHERE id = ?', [task_id])
+
+    def add_deps(self, task_id, after):
+        """ make a new task wait for the tasks in after, or skip it if one of them failed """
+        after = set(after)
+        # the task itself and later ones would block it forever
+        later = sorted(x for x in after if x >= task_id)
+        if later:
+            raise ValueError(f"task {task_id} can only run after earlier tasks, not "
+                             f"{', '.join(str(x) for x in later)}")
+        parents = self.query(f"SELECT id, status, result FROM tasks\
+            WHERE id IN ({', '.join('?' * len(after))})", list(after))
+        missing = after - {row['id'] for row in parents}
+        if missing:
+            raise ValueError(f"no task {', '.join(str(x) for x in sorted(missing))}")
+
+        self.insert_many('deps', [{'task_id': task_id, 'parent_id': parent} for parent in after])
+
+        task = self.query('SELECT command, on_fail FROM tasks WHERE id = ?', [task_id])[0]
+        failed = [row['id'] for row in parents if row['status'] == 2 and row['result'] != 0]
+        if failed and task['on_fail'] == 'skip':
+            self.set_skipped(task_id, task['command'], failed[0])
+        else:
+            self.update('tasks', {
+                'blocked': sum(1 for row in parents if row['status'] != 2),
+            }, {
+                'id': task_id,
+            })
+
+    def add_task(self, command, after=None, **props):
+        """
+            add task, props set other columns such as queue and priority, it waits
+            for the tasks whose ids are in after
+
+        """
         if not isinstance(command, (list, tuple)):
             logger.error('task command must be list of arguments')
             raise ValueError('task command must be list of arguments')
 
         cmd_str = ' '.join(str(x) for x in command)
-        logger.debug(f"add_task - command: {command}, cmd_str: {cmd_str}")
+        logger.debug(f"add_task - command: {command}, cmd_str: {cmd_str}, props: {props}")
 
-        return self.insert('tasks', {
-            'added_at': int(time.time()),
+        now = int(time.time())
+        task_id = self.insert('tasks', {
+            **props,
+            'added_at': now,
             'command': cmd_str,
-            'status': 0,
+            'cmd_hash': command_hash(cmd_str),
+            'status': WAITING if (props.get('not_before') or 0) > now else 0,
         })
+        if after:
+            self.add_deps(task_id, after)
+        return task_id
+
+    def add_tasks(self, commands, replace=False, unique=False, after=None, **props):
+        """
+            add many command strings, returns first and last task id, both None if
+            unique coalesced all of them into pending tasks
+
+        """
+        if replace:
+            # as if each line replaced the ones before it, the last copy wins
+            commands = list(dict.fromkeys(reversed(commands)))[::-1]
+        elif unique:
+            commands = [cmd_str for cmd_str in dict.fromkeys(commands)
+                        if self.coalesce(cmd_str) is None]
+
+        logger.debug(f"add_tasks - commands: {len(commands)}, replace: {replace}, unique: {unique}")
+
+        if replace:
+            for cmd_str in commands:
+                self.delete_command(cmd_str)
+
+        if not commands:
+            return None, None
+
+        now = int(time.time())
+        count = self.insert_many('tasks', [{
+            **props,
+            'added_at': now,
+            'command': cmd_str,
+            'cmd_hash': command_hash(cmd_str),
+            'status': WAITING if (props.get('not_before') or 0) > now else 0,
+        } for cmd_str in commands])
+
+        # the rows got consecutive ids, nobody else can write until we commit
+        last = self.query('SELECT max(id) AS id FROM tasks')[0]['id']
+        if after:
+            for task_id in range(last - count + 1, last + 1):
+                self.add_deps(task_id, after)
+        return last - count + 1, last
+
+    def add_unique_task(self, command, **props):
+        """
+            add task unless the command is already pending, returns the task id
+            and whether the add was coalesced into a pending task
+
+        """
+        if not isinstance(command, (list, tuple)):
+            logger.error('task command must be list of arguments')
+            raise ValueError('task command must be list of arguments')
+
+        task_id = self.coalesce(' '.join(str(x) for x in command))
+        if task_id is not None:
+            return task_id, True
+        return self.add_task(command, **props), False
+
+    def coalesce(self, cmd_str):
+        """
+            count an add against a task running cmd_str that did not start yet,
+            preferring a pending one to a waiting one, returns its id or None
+
+        """
+        rows = self.query('SELECT id FROM tasks WHERE cmd_hash = ? AND status IN (0, 4)\
+            AND command = ? ORDER BY status, id LIMIT 1', [command_hash(cmd_str), cmd_str])
+        if not rows:
+            return None
+
+        self.query('UPDATE tasks SET coalesced = coalesced + 1 WHERE id = ?', [rows[0]['id']])
+        logger.debug(f"coalesce - cmd_str: {cmd_str}, task: {rows[0]['id']}")
+        return rows[0]['id']
+
+    def compact_step(self, after_id=0, codec=OUTPUT_CODEC):
+        """
+            store the outputs of a batch of tasks after after_id with codec,
+            returns the last task id of the batch, None once all were seen,
+            and the number of outputs changed
+
+        """
+        rows = self.query('SELECT task_id, stdout, stderr, size FROM outputs WHERE task_id > ?\
+            ORDER BY task_id LIMIT ?', [after_id, PURGE_BATCH])
+        if not rows:
+            return None, 0
+
+        changed = 0
+        for row in rows:
+            stdout, stderr = (compress(decompress(row[name]), codec) for name in ('stdout', 'stderr'))
+            if stdout == row['stdout'] and stderr == row['stderr']:
+                continue
+            size = (row['size'] or 0) + stored_size(stdout) + stored_size(stderr) \
+                - stored_size(row['stdout']) - stored_size(row['stderr'])
+            self.query('UPDATE outputs SET stdout = ?, stderr = ?, size = ? WHERE task_id = ?',
+                       [stdout, stderr, size, row['task_id']])
+            changed += 1
+
+        return rows[-1]['task_id'], changed
+
+    def count_pending(self):
+        """ number of pending tasks """
+        return self.query('SELECT count(*) AS n FROM tasks WHERE status = 0')[0]['n']
+
+    def delete_command(self, cmd_str):
+        """ delete pending and waiting tasks running cmd_str, finished ones keep their logs """
+        self.query('DELETE FROM tasks WHERE cmd_hash = ? AND status IN (0, 4) AND command = ?',
+                   [command_hash(cmd_str), cmd_str])
+
+    def get_next_task(self, queue, owner=None):
+        """ get next task of a queue, claiming it for owner by setting it running """
+        now = int(time.time())
+        if CLAIM_RETURNING:
+            rows = self.query('UPDATE tasks SET status = 1, run_at = ?, owner = ?, lease_until = ?\
+                WHERE id = (SELECT id FROM tasks WHERE status = 0 AND blocked = 0 AND queue = ?\
+                    ORDER BY priority DESC, id LIMIT 1)\
+                RETURNING id, added_at, command, queue, timeout, retries, attempts, backoff',
+                [now, owner, now + LEASE, queue])
+            return rows[0] if rows else None
+
+        self.begin_transaction(immediate=True)
+        try:
+            rows = self.query('SELECT id, added_at, command, queue, timeout, retries, attempts,\
+                backoff FROM tasks\
+                WHERE status = 0 AND blocked = 0 AND queue = ?\
+                ORDER BY priority DESC, id LIMIT 1', [queue])
+            if rows:
+                self.set_running(int(rows[0]['id']), owner)
+            self.commit()
+        except:
+            self.rollback()
+            raise
 
-    def get_next_task(self):
-        """ get next task """
-        rows = self.query('SELECT id, command FROM tasks WHERE status = 0 ORDER BY id LIMIT 1')
+        return rows[0] if rows else None
+
+    def get_output(self, task_id):
+        """ get task output """
+        rows = self.query('SELECT stdout, stderr FROM outputs WHERE task_id = ?', [task_id])
+        if not rows:
+            return {'stdout': None, 'stderr': None}
+        return {name: decompress(value) for name, value in rows[0].items()}
+
+    def get_state(self, task_id):
+        """ status and result of a task, None if there is no such task """
+        rows = self.query('SELECT status, result FROM tasks WHERE id = ?', [task_id])
         return rows[0] if rows else None
 
     def get_task(self, task_id):
         """ get task details """
         rows = self.query('SELECT * FROM tasks WHERE id = ?', [task_id])
-        return rows[0] if rows else None
+        if not rows:
+            return None
 
-    def list_failed_tasks(self):
+        rows[0].update(self.get_output(task_id))
+        rows[0]['after'] = [row['parent_id'] for row in self.query(
+            'SELECT parent_id FROM deps WHERE task_id = ? ORDER BY parent_id', [task_id])]
+        rows[0]['history'] = self.query('SELECT attempt, run_at, finished_at, result, time_r\
+            FROM attempts WHERE task_id = ? ORDER BY attempt', [task_id])
+        return rows[0]
+
+    def iter_tasks(self, which, limit=None, after_id=None):
+        """ tasks of a list in id order, read from the cursor one batch at a time """
+        return self.iterate(*self.list_query(which, limit, after_id))
+
+    def list_failed_tasks(self, limit=None, after_id=None):
         """ list failed tasks """
-        rows = self.query('SELECT * FROM tasks WHERE status = 2 AND result <> 0 ORDER BY id')
+        rows = self.query(*self.list_query('failed', limit, after_id))
         return rows, len(rows)
 
-    def list_finished_tasks(self):
+    def list_finished_tasks(self, limit=None, after_id=None):
         """ list finished tasks """
-        rows = self.query('SELECT * FROM tasks WHERE status = 2 AND result = 0 ORDER BY id')
+        rows = self.query(*self.list_query('finished', limit, after_id))
         return rows, len(rows)
 
-    def list_last_tasks(self):
+    def list_last_tasks(self, limit=50, after_id=None):
         """ list last tasks """
-        rows = self.query('SELECT * FROM tasks ORDER BY id DESC LIMIT 50')
-        return reversed(rows), len(rows)
+        rows = self.query(*self.list_query('last', limit, after_id))
+        return rows, len(rows)
 
-    def list_pending_tasks(self):
+    def list_query(self, which, limit=None, after_id=None):
+        """ statement and parameters of a task list, keyset paged by after_id """
+        where = LISTS[which]
+        params = []
+        if after_id is not None:
+            where = where + ['id > ?']
+            params.append(after_id)
+
+        query = f'SELECT {LIST_COLUMNS} FROM tasks'
+        if where:
+            query += f" WHERE {' AND '.join(where)}"
+        # the last tasks are the newest ones, still listed oldest first
+        query += ' ORDER BY id DESC' if which == 'last' else ' ORDER BY id'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        if which == 'last':
+            query = f'SELECT * FROM ({query}) ORDER BY id'
+
+        return query, params
+
+    def list_waiting_tasks(self, limit=None, after_id=None):
+        """ list waiting tasks """
+        rows = self.query(*self.list_query('waiting', limit, after_id))
+        return rows, len(rows)
+
+    def list_pending_tasks(self, limit=None, after_id=None):
         """ list pending tasks """
-        rows = self.query('SELECT * FROM tasks WHERE status = 0 ORDER BY id')
+        rows = self.query(*self.list_query('pending', limit, after_id))
         return rows, len(rows)
 
-    def purge_older(self):
-        """ Delete tasks older than 1 week. """
-        since = time.time() - 86400 * 7
-        count = self.query('DELETE FROM tasks WHERE added_at < ?', [since])
+    def next_due(self):
+        """ earliest not_before of the waiting tasks, None if there are none """
+        return self.query('SELECT min(not_before) AS t FROM tasks WHERE status = 4')[0]['t']
+
+    def pending_queues(self):
+        """ names of queues with tasks ready to run """
+        return [row['queue'] for row in self.query(
+            'SELECT DISTINCT queue FROM tasks WHERE status = 0 AND blocked = 0')]
+
+    def promote_due(self, now):
+        """ make waiting tasks due at now pending, returns their number """
+        return self.query('UPDATE tasks SET status = 0 WHERE status = 4 AND not_before <= ?', [now])
+
+    def purge_step(self):
+        """ delete the oldest finished tasks the retention policy drops, one batch at a time """
+        since = time.time() - 86400 * KEEP_DAYS
+        excess_tasks = excess_bytes = 0
+        if KEEP_TASKS:
+            excess_tasks = self.query('SELECT count(*) AS n FROM tasks WHERE status = 2')[0]['n'] \
+                - KEEP_TASKS
+        if KEEP_BYTES:
+            excess_bytes = self.query('SELECT coalesce(sum(size), 0) AS n FROM outputs')[0]['n'] \
+                - KEEP_BYTES
+
+        rows = self.query('SELECT id, added_at, coalesce(size, 0) AS size FROM tasks\
+            LEFT JOIN outputs ON task_id = id WHERE status = 2 ORDER BY added_at, id LIMIT ?',
+            [PURGE_BATCH])
+
+        ids = []
+        for row in rows:
+            if row['added_at'] >= since and excess_tasks <= 0 and excess_bytes <= 0:
+                break
+            ids.append(row['id'])
+            excess_tasks -= 1
+            excess_bytes -= row['size']
+
+        if not ids:
+            return 0
+
+        count = self.query(f"DELETE FROM tasks WHERE id IN ({', '.join(str(i) for i in ids)})")
+        remove_spools(ids)
+        self.reclaim()
         return count
 
     def purge_pending(self):
-        """ Delete all pending tasks """
-        return self.query('DELETE FROM tasks WHERE status = 0')
+        """ Delete all pending and waiting tasks, which stops recurring ones """
+        return self.query('DELETE FROM tasks WHERE status IN (0, 4)')
 
-    def replace_task(self, command):
+    def replace_task(self, command, **props):
         """ replace task """
         if not isinstance(command, (list, tuple)):
             logger.error('task command must be list of arguments')
@@ -201,30 +776,149 @@ class Database(DAL):
         cmd_str = ' '.join(str(x) for x in command)
         logger.debug(f"replace_task - command: {command}, cmd_str: {cmd_str}")
 
-        self.query('DELETE FROM tasks WHERE command = ?', [cmd_str])
-        return self.add_task(command)
+        self.delete_command(cmd_str)
+        return self.add_task(command, **props)
 
-    def reset_running(self):
-        """ reset running tasks """
-        self.query('UPDATE tasks SET status = 0 WHERE status = 1')
+    def queue_mail(self, subject, body, failed):
+        """ queue a notification for the background sender """
+        if MAIL_FAILURES_ONLY and not failed:
+            return None
 
-        Email.send_mail("Running Tasks reset",\
-                    "All running tasks were reset, please check them and re-run as necessary")
+        return self.insert('outbox', {
+            'queued_at': int(time.time()),
+            'subject': subject,
+            'body': body,
+            'failed': int(failed),
+        })
 
-    def set_failed(self, task_id, command, msg, ctime):
-        """ set status to failed """
+    def release(self, task_id, failed):
+        """
+            a task ended, unblock the tasks waiting for it, or skip them if it
+            failed, returns the queues of the tasks that became ready
+
+        """
+        ready = set()
+        ended = [(task_id, failed)]
+        while ended:
+            parent, failed = ended.pop()
+            for child in self.query('SELECT t.id, t.queue, t.command, t.blocked, t.on_fail\
+                    FROM deps d JOIN tasks t ON t.id = d.task_id\
+                    WHERE d.parent_id = ? AND t.status IN (0, 4)', [parent]):
+                if failed and child['on_fail'] == 'skip':
+                    self.set_skipped(child['id'], child['command'], parent)
+                    ended.append((child['id'], True))
+                    continue
+
+                self.query('UPDATE tasks SET blocked = blocked - 1 WHERE id = ?', [child['id']])
+                if child['blocked'] == 1:
+                    ready.add(child['queue'])
+
+        return ready
+
+    def reschedule(self, task_id):
+        """
+            put back the not_before retries moved, add the next run of an ended
+            recurring task, returns when it is due or None
+
+        """
+        rows = self.query('SELECT every, not_before, scheduled_at, attempts, added_at FROM tasks\
+            WHERE id = ?', [task_id])
+        if not rows:
+            return None
+
+        # retries moved not_before, put back the time it was added with
+        scheduled = rows[0]['scheduled_at'] if rows[0]['attempts'] else rows[0]['not_before']
+        if rows[0]['attempts']:
+            self.query('UPDATE tasks SET not_before = ? WHERE id = ?', [scheduled, task_id])
+        if not rows[0]['every']:
+            return None
+
+        # keep the cadence, skipping the runs that were missed
+        now = int(time.time())
+        due = (scheduled or rows[0]['added_at']) + rows[0]['every']
+        if due <= now:
+            due += (now - due) // rows[0]['every'] * rows[0]['every'] + rows[0]['every']
+
+        self.query('INSERT INTO tasks (added_at, command, cmd_hash, queue, priority, on_fail,\
+            timeout, every, retries, backoff, not_before, status)\
+            SELECT ?, command, cmd_hash, queue, priority, on_fail, timeout, every, retries, backoff,\
+                ?, ? FROM tasks WHERE id = ?', [now, due, WAITING, task_id])
+        logger.debug(f"reschedule: [{task_id}] due at {due}")
+        return due
+
+    def renew_leases(self, owner, until):
+        """ extend the leases of the tasks owner runs """
+        return self.query('UPDATE tasks SET lease_until = ? WHERE status = 1 AND owner = ?',
+                          [until, owner])
+
+    def requeue_expired(self, now):
+        """ make running tasks whose lease expired pending again, returns their number """
+        # tasks from before leases have none
+        expired = 'status = 1 AND (lease_until < ? OR lease_until IS NULL)'
+        if not self.query(f'SELECT id FROM tasks WHERE {expired} LIMIT 1', [now]):
+            return 0
+
+        self.begin_transaction(immediate=True)
+        try:
+            rows = self.query(f'SELECT id, command, owner FROM tasks WHERE {expired}', [now])
+            if rows:
+                self.query(f"UPDATE tasks SET status = 0, owner = NULL, lease_until = NULL\
+                    WHERE id IN ({', '.join(str(row['id']) for row in rows)})")
+                self.queue_mail(f"{len(rows)} running tasks requeued",
+                    "Their daemon stopped renewing its lease, they will run again:\n"
+                    + '\n'.join(f"{row['id']} ({row['owner']}): {row['command']}" for row in rows),
+                    True)
+            self.commit()
+        except:
+            self.rollback()
+            raise
+
+        return len(rows)
+
+    def retry(self, task_id, due):
+        """ put a failed task back in the queue, to run again at due """
+        return self.query('UPDATE tasks SET status = ?, not_before = ?, attempts = attempts + 1,\
+            scheduled_at = CASE WHEN attempts = 0 THEN not_before ELSE scheduled_at END,\
+            owner = NULL, lease_until = NULL WHERE id = ?', [WAITING, due, task_id])
+
+    def stats(self, since):
+        """ counts and wait/run time percentiles of tasks finished since then """
+        window = 'FROM tasks WHERE status = 2 AND finished_at >= ?'
+        row = self.query(f'SELECT count(*) AS finished, coalesce(sum(result <> 0), 0) AS failed\
+            {window}', [since])[0]
+        stats = {
+            'finished': row['finished'],
+            'failed': row['failed'],
+            'pending': self.count_pending(),
+            'running': self.query('SELECT count(*) AS n FROM tasks WHERE status = 1')[0]['n'],
+        }
+
+        for name, expr in (('wait', 'run_at - added_at'), ('run', 'time_r')):
+            count = self.query(f'SELECT count({expr}) AS n {window}', [since])[0]['n']
+            for pct in (50, 95, 99):
+                rows = self.query(f'SELECT {expr} AS v {window} AND {expr} IS NOT NULL\
+                    ORDER BY v LIMIT 1 OFFSET ?', [since, min(count - 1, count * pct // 100)]) \
+                    if count else []
+                stats[f'{name}_p{pct}'] = rows[0]['v'] if rows else None
+
+        return stats
+
+    def set_failed(self, task_id, command, msg, ctime, result=-1, stdout=None, mail=True):
+        """ set status to failed, result tells why, like TIMED_OUT """
         logger.debug(f"set_failed: [{task_id}], [{command}], [{msg}], [{ctime}]")
 
         if not isinstance(task_id, int):
             logger.error('task_id must be an integer')
             raise ValueError('task_id must be an integer')
 
-        Email.send_mail("Task Failed", f"Task id: {task_id}\nTask: {command}\nOutput: {msg}")
+        if mail:
+            self.queue_mail("Task Failed", f"Task id: {task_id}\nTask: {command}\nOutput: {msg}",
+                            True)
+        self.set_output(task_id, stdout, msg)
 
         return self.update('tasks', {
             'status': 2,
-            'stderr': msg,
-            'result': -1,
+            'result': result,
             'finished_at': int(time.time()),
             'time_r': ctime.rtime,
             'time_u': ctime.utime,
@@ -233,7 +927,7 @@ class Database(DAL):
             'id': task_id,
         })
 
-    def set_finished(self, task_id, command, coutput, ctime):
+    def set_finished(self, task_id, command, coutput, ctime, usage=None, mail=True):
         """ set status to finished """
         logger.debug(f"set_finished: [{task_id}], [{command}], [{coutput.rc}], [{ctime.rtime}]")
 
@@ -241,26 +935,53 @@ class Database(DAL):
             logger.error('task_id must be an integer')
             raise ValueError('task_id must be an integer')
 
-        if not command == 'reload':
-            Email.send_mail(f"the task {task_id} finished with error {coutput.rc}",
-                f"Command: {command}\nOutput:{coutput.stdout}")
+        if mail and not command == 'reload':
+            self.queue_mail(f"the task {task_id} finished with error {coutput.rc}",
+                f"Command: {command}\nOutput:{coutput.stdout}", coutput.rc != 0)
+        self.set_output(task_id, coutput.stdout, coutput.stderr)
 
-        return self.update('tasks', {
+        props = {
             'status': 2,
-            'stdout': coutput.stdout,
-            'stderr': coutput.stderr,
             'result': coutput.rc,
             'finished_at': int(time.time()),
             'time_r': ctime.rtime,
             'time_u': ctime.utime,
             'time_s': ctime.stime,
+        }
+        if usage is not None:
+            props.update(vars(usage))
+
+        return self.update('tasks', props, {
+            'id': task_id,
+        })
+
+    def set_skipped(self, task_id, command, parent_id):
+        """ a task will not run, as a task it runs after failed """
+        logger.debug(f"set_skipped: [{task_id}], [{command}], [{parent_id}]")
+
+        msg = f'Skipped, task {parent_id} failed.'
+        self.queue_mail("Task Skipped", f"Task id: {task_id}\nTask: {command}\nOutput: {msg}", True)
+        self.set_output(task_id, None, msg)
+
+        return self.update('tasks', {
+            'status': 2,
+            'result': SKIPPED,
+            'finished_at': int(time.time()),
         }, {
             'id': task_id,
         })
 
-    def set_running(self, task_id):
-        """ set status to running """
-        logger.debug(f"set_running: [{task_id}]")
+    def set_output(self, task_id, stdout, stderr):
+        """ store task output, compressed above COMPRESS_MIN bytes """
+        stdout, stderr = compress(stdout), compress(stderr)
+        size = spool_size(task_id) + stored_size(stdout) + stored_size(stderr)
+
+        return self.query('INSERT OR REPLACE INTO outputs (task_id, stdout, stderr, size)\
+            VALUES (?, ?, ?, ?)', [task_id, stdout, stderr, size])
+
+    def set_running(self, task_id, owner=None):
+        """ set status to running, leased to owner """
+        logger.debug(f"set_running: [{task_id}], [{owner}]")
 
         if not isinstance(task_id, int):
             logger.error('task_id must be an integer')
@@ -269,6 +990,8 @@ class Database(DAL):
         return self.update('tasks', {
             'status': 1,
             'run_at': int(time.time()),
+            'owner': owner,
+            'lease_until': int(time.time()) + LEASE,
         }, {
             'id': task_id,
         })
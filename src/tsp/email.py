@@ -7,15 +7,25 @@
 import logging
 import os
 import subprocess
+import threading
+import time
 
 from email.message import EmailMessage
 from dataclasses import dataclass
+from tsp.database import Database
 
 logger = logging.getLogger(__name__)
 
 SENDMAIL_LOCATION = "/usr/sbin/sendmail"
 RECIPIENT_EMAIL = os.getenv('TS_MAILTO')
 
+# notifications per mail, and seconds to wait for a digest to fill up
+MAIL_DIGEST = max(1, int(os.getenv('TS_MAIL_DIGEST', '1')))
+MAIL_WINDOW = int(os.getenv('TS_MAIL_WINDOW', '0'))
+# first retry delay after a failed send, doubled for each further attempt
+MAIL_RETRY = 60
+MAIL_RETRY_MAX = 3600
+
 @dataclass
 class Email:
     """ email class """
@@ -36,3 +46,67 @@ class Email:
         except Exception as e:
             logger.error(f"Email send error: {e}")
             raise
+
+
+class Notifier(threading.Thread):
+    """ Background sender draining the outbox table """
+
+    def __init__(self):
+        super().__init__(name='notifier', daemon=True)
+        self.event = threading.Event()
+
+    @staticmethod
+    def compose(rows):
+        """ subject and body for one notification or a digest of several """
+        if len(rows) == 1:
+            return rows[0]['subject'], rows[0]['body']
+
+        failed = sum(1 for row in rows if row['failed'])
+        subject = f"{len(rows)} task notifications, {failed} failed"
+        body = '\n\n'.join(f"--- {row['subject']} ---\n{row['body']}" for row in rows)
+        return subject, body
+
+    def notify(self):
+        """ new notifications were queued """
+        self.event.set()
+
+    def run(self):
+        """ send due notifications, then sleep until more are due or queued """
+        db = Database()
+        while True:
+            try:
+                delay = self.send_due(db)
+            except Exception as e: # pylint: disable=broad-except
+                logger.error(f"Notifier error: {e}")
+                delay = MAIL_RETRY
+
+            if delay is None or delay > 0:
+                self.event.wait(delay)
+                self.event.clear()
+
+    def send_due(self, db):
+        """ send one mail if any is due, returns seconds until the next one """
+        now = int(time.time())
+        rows = db.query('SELECT * FROM outbox WHERE next_try_at <= ? ORDER BY id LIMIT ?',
+                        [now, MAIL_DIGEST])
+        if not rows:
+            rows = db.query('SELECT min(next_try_at) AS next_try_at FROM outbox')
+            return rows[0]['next_try_at'] - now if rows[0]['next_try_at'] else None
+
+        # wait for the digest to fill up, unless the oldest entry waited long enough
+        if len(rows) < MAIL_DIGEST and rows[0]['queued_at'] + MAIL_WINDOW > now:
+            return rows[0]['queued_at'] + MAIL_WINDOW - now
+
+        ids = ', '.join(str(row['id']) for row in rows)
+        try:
+            Email.send_mail(*self.compose(rows))
+        except Exception: # pylint: disable=broad-except
+            attempts = max(row['attempts'] for row in rows)
+            retry = min(MAIL_RETRY * 2 ** attempts, MAIL_RETRY_MAX)
+            logger.error(f"Sending notifications {ids} failed, retry in {retry}s")
+            db.query(f'UPDATE outbox SET attempts = attempts + 1, next_try_at = ? WHERE id IN ({ids})',
+                     [now + retry])
+            return 0
+
+        db.query(f'DELETE FROM outbox WHERE id IN ({ids})')
+        return 0
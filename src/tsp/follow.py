@@ -0,0 +1,225 @@
+# pylint: disable=logging-fstring-interpolation
+# vim: set ts=4 sts=4 sw=4 et tw=0:
+"""
+    Follow the output of a task while it runs, like tail -f
+
+    The daemon appends each output stream to a spool file as it arrives,
+    past its head to tail segments next to it.  Followers wait on an inotify
+    watch of the spool folder, read what was appended and only look at the
+    task's status now and then, or as soon as its spool files are closed.
+    Without inotify they poll the files.  Followers that fall a whole
+    segment behind skip it, like the spool file keeps only the tail.
+
+"""
+
+import ctypes
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+from tsp.database import Database
+from tsp.spool import spool_path, tail_path
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['follow']
+
+# seconds between checks of the task's status while it writes nothing
+FOLLOW_CHECK = float(os.getenv('TS_FOLLOW_CHECK', '5'))
+# seconds between reads of the spool files without inotify
+FOLLOW_POLL = 0.5
+# seconds between status checks once the spool files were closed, the result is committed next
+FOLLOW_SETTLE = 0.05
+READ_SIZE = 65536
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+EVENT = struct.Struct('iIII')
+
+
+class Inotify:
+    """ inotify watch of a folder, through libc as the standard library has no binding """
+
+    def __init__(self, path):
+        # raises AttributeError where libc has no inotify
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                  IN_MODIFY | IN_CLOSE_WRITE | IN_CREATE | IN_DELETE) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f'cannot watch {path}')
+
+    def close(self):
+        """ remove the watch """
+        os.close(self.fd)
+
+    def wait(self, timeout):
+        """ block until files change or timeout, returns {name: mask} of the changes """
+        changes = {}
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changes
+
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return changes
+
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            changes[name] = changes.get(name, 0) | mask
+        return changes
+
+
+class Stream:
+    """ Copies what a task appends to one of its spool files and then to its tail segments """
+
+    def __init__(self, task_id, name, out):
+        self.name = name
+        self.path = spool_path(task_id, name)
+        self.tail = tail_path(task_id, name)
+        self.filename = os.path.basename(self.path)
+        self.out = out
+        self.file = None
+        # the tail segment being read, the spool file is complete once there is one
+        self.segment = None
+        # a file was written and moved to the database before it could be read
+        self.missed = False
+
+    def close(self):
+        """ close the spool file and tail segment """
+        if self.file:
+            self.file.close()
+        self.close_segment()
+
+    def close_segment(self):
+        """ close the tail segment """
+        if self.segment:
+            self.segment.close()
+            self.segment = None
+
+    def copy(self, file):
+        """ copy what was appended to an open file """
+        while chunk := file.read(READ_SIZE):
+            self.out.write(chunk)
+        self.out.flush()
+
+    def follow_tail(self):
+        """ copy what was appended to the tail segments, moving on to the next one """
+        while True:
+            if self.segment is not None:
+                self.copy(self.segment)
+            try:
+                inode = os.stat(self.tail).st_ino
+            except FileNotFoundError:
+                return
+            if self.segment is not None and inode == os.fstat(self.segment.fileno()).st_ino:
+                return
+
+            # the one set aside first, unless it is the one we read
+            paths = [self.tail] if self.segment is not None else [self.tail + '.old', self.tail]
+            self.close_segment()
+            for path in paths:
+                try:
+                    self.segment = open(path, 'rb') # pylint: disable=consider-using-with
+                    break
+                except FileNotFoundError:
+                    pass
+            else:
+                return
+
+    def read(self, created=False):
+        """ copy the output appended since the last read, created if the file was written anew """
+        try:
+            if self.file is not None:
+                # a retry writes the file again from its start
+                if os.fstat(self.file.fileno()).st_size < self.file.tell():
+                    self.file.seek(0)
+                    self.close_segment()
+                # past its head it only gets the tail we read from the segments
+                if self.segment is None:
+                    self.copy(self.file)
+                # or as a new file once the last one was removed
+                if os.stat(self.path).st_ino == os.fstat(self.file.fileno()).st_ino:
+                    self.follow_tail()
+                    return
+                self.file.close()
+                self.file = None
+                self.close_segment()
+
+            self.file = open(self.path, 'rb') # pylint: disable=consider-using-with
+        except FileNotFoundError:
+            self.missed = self.missed or bool(created)
+            return
+        self.missed = False
+        self.copy(self.file)
+        self.follow_tail()
+
+
+def follow(task_id):
+    """ stream the output of a task until it ended, returns its result, None if there is none """
+    db = Database()
+    if not db.get_state(task_id):
+        return None
+
+    streams = [Stream(task_id, 'stdout', sys.stdout.buffer),
+               Stream(task_id, 'stderr', sys.stderr.buffer)]
+    folder = os.path.dirname(streams[0].path)
+    os.makedirs(folder, exist_ok=True)
+    try:
+        watch = Inotify(folder)
+    except (AttributeError, OSError) as e:
+        logger.debug(f"follow: polling, no inotify: {e}")
+        watch = None
+
+    try:
+        check_at = 0
+        changes = {}
+        while True:
+            for stream in streams:
+                stream.read(changes.get(stream.filename, 0) & IN_CREATE)
+
+            if time.monotonic() >= check_at:
+                state = db.get_state(task_id)
+                # replaced while it was pending
+                if state is None:
+                    return None
+                if state['status'] == 2:
+                    # what was written before the result was committed
+                    for stream in streams:
+                        stream.read()
+                    break
+                check_at = time.monotonic() + FOLLOW_CHECK
+
+            if watch is None:
+                time.sleep(FOLLOW_POLL)
+                continue
+
+            changes = watch.wait(max(0, check_at - time.monotonic()))
+            if any(changes.get(stream.filename, 0) & (IN_CLOSE_WRITE | IN_DELETE)
+                   for stream in streams):
+                check_at = min(check_at, time.monotonic() + FOLLOW_SETTLE)
+    finally:
+        if watch:
+            watch.close()
+        for stream in streams:
+            stream.close()
+
+    # short outputs are moved to the database when the task ends
+    output = db.get_output(task_id)
+    for stream in streams:
+        if (stream.file is None or stream.missed) and output[stream.name]:
+            stream.out.write(output[stream.name].encode())
+            stream.out.flush()
+
+    return state['result']
@@ -0,0 +1,123 @@
+# pylint: disable=logging-fstring-interpolation
+# vim: set ts=4 sts=4 sw=4 et tw=0:
+""" Daemon metrics, exported to a Prometheus textfile or a JSON file """
+
+import json
+import logging
+import os
+import time
+
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['Metrics', 'METRICS_FILE', 'METRICS_INTERVAL']
+
+# files ending in .prom are written for the node exporter textfile collector, others as JSON
+METRICS_FILE = os.getenv('TS_METRICS_FILE')
+METRICS_INTERVAL = int(os.getenv('TS_METRICS_INTERVAL', '15'))
+
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+
+class Histogram:
+    """ Cumulative histogram with fixed buckets """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        """ add a value """
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def to_dict(self):
+        """ JSON friendly form """
+        return {
+            'buckets': {str(b): c for b, c in zip(self.buckets, self.counts)},
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class Metrics:
+    """ Counters, gauges and histograms kept by the scheduler """
+
+    def __init__(self, path=METRICS_FILE):
+        self.path = path
+        self.counters = {'tasks_started': 0, 'tasks_finished': 0, 'tasks_failed': 0}
+        self.gauges = {'queue_depth': 0, 'running': 0, 'completions_per_minute': 0}
+        self.histograms = {
+            'wait_seconds': Histogram(),
+            'run_seconds': Histogram(),
+            'db_seconds': Histogram(),
+        }
+        self.completions = deque()
+
+    def export(self, queue_depth, running):
+        """ write all metrics, replacing the file atomically """
+        now = time.time()
+        self.trim(now)
+        self.gauges.update({
+            'queue_depth': queue_depth,
+            'running': running,
+            'completions_per_minute': len(self.completions),
+        })
+
+        if self.path.endswith('.prom'):
+            data = self.to_prometheus()
+        else:
+            data = json.dumps({
+                'time': now,
+                'counters': self.counters,
+                'gauges': self.gauges,
+                'histograms': {k: h.to_dict() for k, h in self.histograms.items()},
+            }, indent=2)
+
+        tmp = f'{self.path}.tmp'
+        try:
+            with open(tmp, 'w', encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.error(f"Cannot export metrics to {self.path}: {e}")
+
+    def finished(self, run_time, failed):
+        """ a task finished after run_time seconds """
+        self.counters['tasks_failed' if failed else 'tasks_finished'] += 1
+        self.histograms['run_seconds'].observe(run_time)
+        now = time.time()
+        self.completions.append(now)
+        # also without exports, which daemons other than the primary never do
+        self.trim(now)
+
+    def started(self, wait_time):
+        """ a task started after waiting wait_time seconds in the queue """
+        self.counters['tasks_started'] += 1
+        self.histograms['wait_seconds'].observe(wait_time)
+
+    def trim(self, now):
+        """ forget completions older than a minute """
+        while self.completions and self.completions[0] < now - 60:
+            self.completions.popleft()
+
+    def to_prometheus(self):
+        """ text exposition format """
+        lines = []
+        for name, value in self.counters.items():
+            lines += [f'# TYPE tsp_{name}_total counter', f'tsp_{name}_total {value}']
+        for name, value in self.gauges.items():
+            lines += [f'# TYPE tsp_{name} gauge', f'tsp_{name} {value}']
+        for name, hist in self.histograms.items():
+            lines.append(f'# TYPE tsp_{name} histogram')
+            for bound, count in zip(hist.buckets, hist.counts):
+                lines.append(f'tsp_{name}_bucket{{le="{bound}"}} {count}')
+            lines += [f'tsp_{name}_bucket{{le="+Inf"}} {hist.count}',
+                      f'tsp_{name}_sum {hist.sum}', f'tsp_{name}_count {hist.count}']
+        return '\n'.join(lines) + '\n'
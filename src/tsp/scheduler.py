@@ -0,0 +1,594 @@
+# pylint: disable=logging-fstring-interpolation
+# vim: set ts=4 sts=4 sw=4 et tw=0:
+""" Scheduler implementation """
+
+import fcntl
+import heapq
+import logging
+import itertools
+import os
+import random
+import selectors
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+
+from dataclasses import dataclass
+from tsp.admission import Admission, RECHECK_INTERVAL
+from tsp.api import ApiServer
+from tsp.database import LEASE, PURGE_BATCH, TIMED_OUT
+from tsp.email import Notifier
+from tsp.metrics import Metrics, METRICS_FILE, METRICS_INTERVAL
+from tsp.spool import Spool, remove_spools
+from tsp.wakeup import WakeChannel, wake_daemon
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['Scheduler']
+
+POLL_INTERVAL = 1
+READ_SIZE = 65536
+# seconds between retention checks, batches are deleted back to back until done
+PURGE_INTERVAL = int(os.getenv('TS_PURGE_INTERVAL', '300'))
+# seconds a timed out task gets between SIGTERM and SIGKILL
+KILL_GRACE = float(os.getenv('TS_KILL_GRACE', '10'))
+# seconds before the first retry of a failed task, doubled for each further one
+BACKOFF = float(os.getenv('TS_BACKOFF', '60'))
+BACKOFF_MAX = float(os.getenv('TS_BACKOFF_MAX', '3600'))
+# held by the primary daemon, which serves the API, sends mail and enforces retention
+LOCK_PATH = os.path.expanduser('~/.cache/tsp.lock')
+
+
+@dataclass
+class CalcTimes:
+    """ Calculated Times """
+    utime = None
+    stime = None
+    rtime = None
+    def get_elapsed(self, then):
+        """ get elapsed times """
+        now = os.times()
+        self.utime = now[0] - then[0]
+        self.stime = now[1] - then[1]
+        self.rtime = now[4] - then[4]
+        return self
+    def get_real(self, then):
+        """ real time since then only, for a task whose CPU times are not known """
+        self.rtime = os.times()[4] - then[4]
+        return self
+    def get_usage(self, rusage, then):
+        """ CPU times of a single reaped child, real time since then """
+        self.utime = rusage.ru_utime
+        self.stime = rusage.ru_stime
+        self.rtime = os.times()[4] - then[4]
+        return self
+
+
+@dataclass
+class ResUsage:
+    """ Resources used by a reaped task """
+    max_rss = None
+    blk_in = None
+    blk_out = None
+    ctx_vol = None
+    ctx_invol = None
+    io_read = None
+    io_write = None
+    def get_usage(self, rusage, io):
+        """ use wait4 rusage and /proc/<pid>/io counters """
+        self.max_rss = rusage.ru_maxrss
+        self.blk_in = rusage.ru_inblock
+        self.blk_out = rusage.ru_oublock
+        self.ctx_vol = rusage.ru_nvcsw
+        self.ctx_invol = rusage.ru_nivcsw
+        self.io_read = io.get('read_bytes')
+        self.io_write = io.get('write_bytes')
+        return self
+
+
+@dataclass
+class CmdOutput:
+    """ Command return values """
+    rc = 0
+    stdout = None
+    stderr = None
+    def get_result(self, returncode, output, error):
+        """ use passed params """
+        self.rc = returncode
+        self.stdout = output
+        self.stderr = error
+        return self
+
+
+@dataclass
+class Job:
+    """ A task whose child process is running """
+    task_id: int
+    command: str
+    queue: str
+    proc: subprocess.Popen
+    start_time: tuple
+    output: dict
+    pipes: int = 2
+    timeout: float = 0
+    deadline: float = None
+    # the claimed task's retries, attempts and backoff
+    policy: dict = None
+
+
+def backoff(base, attempts):
+    """ seconds before the next retry, exponential with jitter so that retries spread out """
+    delay = min((base or BACKOFF) * 2 ** attempts, BACKOFF_MAX)
+    return random.uniform(delay / 2, delay)
+
+
+def will_retry(policy, failed):
+    """ whether a task that ended goes back to the queue """
+    return failed and policy is not None and (policy['attempts'] or 0) < (policy['retries'] or 0)
+
+
+def find_executable(command):
+    """ find command executeable """
+    if os.path.exists(command):
+        return command
+
+    base = os.path.basename(command)
+
+    for folder in os.getenv('PATH').split(os.path.pathsep):
+        exe = os.path.join(folder, base)
+        if os.path.exists(exe):
+            return exe
+
+    logger.error(f'command {base} not found')
+    raise RuntimeError(f'command {base} not found')
+
+
+def has_exited(pid):
+    """ whether a child exited, without waiting or reaping it """
+    return os.waitid(os.P_PID, pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
+
+
+def proc_io(pid):
+    """ I/O counters of a process that exited but was not reaped yet """
+    try:
+        with open(f'/proc/{pid}/io', encoding="utf-8") as f:
+            return {k: int(v) for k, v in (line.split(': ') for line in f)}
+    except (OSError, ValueError):
+        return {}
+
+
+def reap(proc):
+    """ reap a child that exited, returns its exit code, rusage and I/O counters """
+    # read before reaping, /proc/<pid> goes away with the zombie
+    io = proc_io(proc.pid)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return proc.returncode, rusage, io
+
+
+def exit_on_signal(signum, _frame):
+    """ turn SIGTERM and SIGHUP into an exit, so that run() cleans up like on an interrupt """
+    raise SystemExit(128 + signum)
+
+
+def signal_group(pid, sig):
+    """ signal the process group a task leads, which may be gone already """
+    try:
+        os.killpg(pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def spawn(command):
+    """ start command without waiting for it, in a session and process group of its own """
+    command = command.split()
+    command[0] = find_executable(command[0])
+    logger.debug(f"spawn - command: {command}")
+    return subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            start_new_session=True)
+
+
+class Scheduler:
+    """
+        Keep up to `slots` tasks running, recording each one as it exits
+
+        Several daemons may share the database, each claims tasks with a lease
+        it renews while they run.  The one holding LOCK_PATH is the primary.
+
+    """
+
+    def __init__(self, db, slots=1, queue_slots=None, admission=None, timeout=0, queues=None):
+        self.db = db
+        self.slots = max(1, slots)
+        self.queue_slots = queue_slots or {}
+        # only run tasks of these queues, all if None
+        self.queues = set(queues) if queues else None
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.next_heartbeat = time.monotonic()
+        self.admission = admission or Admission()
+        # seconds tasks without a timeout of their own may run, 0 for no limit
+        self.default_timeout = timeout
+        # process groups of timed out tasks, by leader pid, with the time they get SIGKILL
+        self.killing = {}
+        self.recheck = None
+        # queues with ready tasks, kept up to date as tasks are added and end,
+        # read from the database again when a client wrote to it directly
+        self.ready = set()
+        self.rescan = True
+        # min-heap of times waiting tasks are due, its top is the earliest one
+        self.due = []
+        # queues take turns, the one served least recently goes first
+        self.turns = {}
+        self.turn = itertools.count(1)
+        self.selector = selectors.DefaultSelector()
+        self.jobs = {}
+        self.reloading = False
+
+        self.metrics = Metrics()
+        self.db.observer = self.metrics.histograms['db_seconds'].observe
+
+        try:
+            self.wake = WakeChannel()
+            self.selector.register(self.wake, selectors.EVENT_READ, None)
+        except OSError as e:
+            logger.warning(f"Cannot listen for wake ups, polling every {POLL_INTERVAL}s: {e}")
+            self.wake = None
+
+        # set up by elect() in the primary daemon
+        self.lock = None
+        self.api = None
+        self.notifier = None
+        self.next_purge = None
+        self.next_export = None
+        self.elect()
+
+    def dispatch(self):
+        """ start ready tasks while there are free slots, taking turns between queues """
+        if self.rescan or not self.wake:
+            self.ready = set()
+            self.mark_ready(self.db.pending_queues())
+            self.schedule(self.db.next_due())
+            self.rescan = False
+
+        while self.ready and not self.reloading and len(self.jobs) < self.slots:
+            ready = [queue for queue in self.ready if self.has_slot(queue)]
+            if not ready:
+                return
+
+            if not self.admission.check():
+                self.recheck = time.monotonic() + RECHECK_INTERVAL
+                return
+            self.recheck = None
+
+            queue = min(ready, key=lambda name: self.turns.get(name, 0))
+            task = self.db.get_next_task(queue, self.owner)
+            if task is None:
+                self.ready.discard(queue)
+                continue
+
+            self.turns[queue] = next(self.turn)
+            self.start(task)
+
+    def elect(self):
+        """ become the primary daemon, unless another one is """
+        if self.lock:
+            return
+
+        os.makedirs(os.path.dirname(LOCK_PATH), exist_ok=True)
+        lock = open(LOCK_PATH, 'w', encoding="utf-8") # pylint: disable=consider-using-with
+        try:
+            fcntl.lockf(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            return
+
+        # kept open, the lock is held until we exit
+        self.lock = lock
+        logger.info(f'{self.owner} is the primary daemon.')
+
+        self.notifier = Notifier()
+        self.notifier.start()
+        self.next_purge = time.monotonic()
+        self.next_export = time.monotonic() if METRICS_FILE else None
+
+        try:
+            self.api = ApiServer(self.db, self.selector)
+        except OSError as e:
+            logger.warning(f"Cannot serve the API, clients write to the database: {e}")
+
+    def ended(self, task_id, failed, policy=None):
+        """
+            retry a task that failed if its policy allows, otherwise release its
+            dependents and schedule its next run, commits
+
+        """
+        if policy and policy['retries']:
+            self.db.add_attempt(task_id)
+
+        if will_retry(policy, failed):
+            due = int(time.time() + backoff(policy['backoff'], policy['attempts'] or 0))
+            self.db.retry(task_id, due)
+            self.schedule(due)
+            logger.info(f"Task {task_id} will be retried at {time.ctime(due)}.")
+            ready = set()
+        else:
+            ready = self.db.release(task_id, failed)
+            self.mark_ready(ready)
+            self.schedule(self.db.reschedule(task_id))
+        self.db.commit()
+        # dependents may wait in queues other daemons serve
+        if ready:
+            wake_daemon()
+        self.notify()
+
+    def expire(self, job):
+        """ a task ran out of time: signal its process group, record it and free its slot """
+        del self.jobs[job.task_id]
+        signal_group(job.proc.pid, signal.SIGTERM)
+        self.killing[job.proc.pid] = (job.proc, time.monotonic() + KILL_GRACE)
+        logger.warning(f"Task {job.task_id} timed out after {job.timeout}s.")
+
+        for name, spool in job.output.items():
+            pipe = getattr(job.proc, name)
+            if not pipe.closed:
+                self.selector.unregister(pipe)
+                pipe.close()
+            spool.close()
+        stderr = job.output['stderr'].excerpt()
+        msg = f"{stderr.rstrip()}\n" if stderr else ''
+
+        # its group is only reaped later, maybe after a retry reused the row, and the
+        # CPU times of all our children since it started are not its own
+        self.db.begin_transaction(immediate=True)
+        self.db.set_failed(job.task_id, job.command, f'{msg}Timed out after {job.timeout}s.',
+                           CalcTimes().get_real(job.start_time), TIMED_OUT,
+                           job.output['stdout'].excerpt(), not will_retry(job.policy, True))
+        self.ended(job.task_id, True, job.policy)
+        self.metrics.finished(os.times()[4] - job.start_time[4], True)
+
+    def export(self):
+        """ write metrics every METRICS_INTERVAL seconds """
+        if self.next_export is None or time.monotonic() < self.next_export:
+            return
+
+        self.metrics.export(self.db.count_pending(), len(self.jobs))
+        self.next_export = time.monotonic() + METRICS_INTERVAL
+
+    def finish(self, job):
+        """ reap the child, which exited, and record its result """
+        del self.jobs[job.task_id]
+
+        rc, rusage, io = reap(job.proc)
+        logger.debug(f"finish: command: {job.command}, rc: {rc}, rusage: {rusage}")
+
+        # the task ends and its dependents are released in one transaction
+        self.db.begin_transaction(immediate=True)
+        try:
+            for spool in job.output.values():
+                spool.close()
+            output = CmdOutput().get_result(rc, job.output['stdout'].excerpt(),
+                                            job.output['stderr'].excerpt())
+            # no mail about attempts that are retried
+            self.db.set_finished(job.task_id, job.command, output,
+                                 CalcTimes().get_usage(rusage, job.start_time),
+                                 ResUsage().get_usage(rusage, io),
+                                 not will_retry(job.policy, rc != 0))
+            self.metrics.finished(os.times()[4] - job.start_time[4], rc != 0)
+            logger.info(f"Task {job.task_id} finished.")
+        except (OSError, ValueError, sqlite3.Error) as e:
+            rc = -1
+            self.db.set_failed(job.task_id, job.command, str(e),
+                               CalcTimes().get_elapsed(job.start_time),
+                               mail=not will_retry(job.policy, True))
+            self.metrics.finished(os.times()[4] - job.start_time[4], True)
+            logger.error(f"Task {job.task_id} failed: {e}.")
+
+        self.ended(job.task_id, rc != 0, job.policy)
+
+    def heartbeat(self):
+        """ renew our leases, requeue tasks whose daemon stopped renewing theirs """
+        if time.monotonic() < self.next_heartbeat:
+            return
+
+        now = int(time.time())
+        self.db.renew_leases(self.owner, now + LEASE)
+        count = self.db.requeue_expired(now)
+        if count:
+            logger.warning(f'Requeued {count} tasks whose lease expired.')
+        # a cheap look for tasks a missed wake-up left pending
+        self.rescan = True
+
+        self.elect()
+        # mail queued by other daemons
+        self.notify()
+        self.next_heartbeat = time.monotonic() + LEASE / 3
+
+    def has_slot(self, queue):
+        """ whether queue is below its own limit of running tasks """
+        running = sum(1 for job in self.jobs.values() if job.queue == queue)
+        return running < self.queue_slots.get(queue, self.slots)
+
+    def mark_ready(self, queues):
+        """ queues that have tasks ready to run, if we run their tasks """
+        self.ready |= set(queues) & self.queues if self.queues else set(queues)
+
+    def notify(self):
+        """ let the primary daemon send queued mail """
+        if self.notifier:
+            self.notifier.notify()
+
+    def promote(self):
+        """ make waiting tasks pending once they are due """
+        now = time.time()
+        if not self.due or self.due[0] > now:
+            return
+
+        while self.due and self.due[0] <= now:
+            heapq.heappop(self.due)
+        count = self.db.promote_due(int(now))
+        # another daemon may have promoted them first
+        self.rescan = True
+        if count:
+            logger.info(f'{count} waiting tasks are due.')
+            # in queues other daemons may serve
+            wake_daemon()
+        self.schedule(self.db.next_due())
+
+    def purge(self):
+        """ enforce the retention policy a batch at a time, between dispatches """
+        if self.next_purge is None or time.monotonic() < self.next_purge:
+            return
+
+        count = self.db.purge_step()
+        if count:
+            logger.info(f'Purged {count} old tasks.')
+        self.next_purge = time.monotonic() + (0 if count >= PURGE_BATCH else PURGE_INTERVAL)
+
+    def run(self):
+        """ main loop, only returns by exiting for a reload """
+        for signum in (signal.SIGTERM, signal.SIGHUP):
+            signal.signal(signum, exit_on_signal)
+        try:
+            while True:
+                if self.api and self.api.flush():
+                    # the other daemons may run them too
+                    wake_daemon()
+                    self.rescan = True
+                self.heartbeat()
+                self.watchdog()
+                self.promote()
+                self.dispatch()
+
+                if self.reloading and not self.jobs:
+                    logger.info('Reloading Tasks.')
+                    sys.exit(0)
+
+                self.purge()
+                self.export()
+                self.wait(self.timeout())
+        finally:
+            # the signal may have arrived in the middle of a transaction
+            if self.db.db.in_transaction:
+                self.db.rollback()
+            # tasks run in process groups of their own, which an interrupt does not reach
+            for job in self.jobs.values():
+                signal_group(job.proc.pid, signal.SIGTERM)
+            for pid in self.killing:
+                signal_group(pid, signal.SIGKILL)
+            if self.api:
+                self.api.close()
+            if self.wake:
+                self.wake.close()
+
+    def schedule(self, due):
+        """ wake up at due, a time in seconds since the epoch, unless it is None """
+        # later times are read from the database once the earlier ones are done
+        if due is not None and (not self.due or due < self.due[0]):
+            heapq.heappush(self.due, due)
+
+    def start(self, task):
+        """ start a claimed task """
+        task_id = int(task['id'])
+        logger.info(f"Running task {task_id}: {task['command']}")
+
+        if task['command'] == 'reload':
+            # finish whatever is running, then exit so that systemd restarts us
+            self.db.begin_transaction(immediate=True)
+            self.db.set_finished(task_id, task['command'],
+                                 CmdOutput().get_result(0, None, None),
+                                 CalcTimes().get_elapsed(os.times()))
+            self.ended(task_id, False)
+            self.reloading = True
+            return
+
+        self.metrics.started(time.time() - task['added_at'])
+        start_time = os.times()
+        output = {}
+        try:
+            timeout = float(task['timeout'] or self.default_timeout)
+            for name in ('stdout', 'stderr'):
+                output[name] = Spool(task_id, name)
+            proc = spawn(task['command'])
+        except (OSError, RuntimeError, ValueError) as e:
+            # empty spool files would hide the error in tsp -s
+            for spool in output.values():
+                spool.close()
+            remove_spools([task_id])
+            self.db.begin_transaction(immediate=True)
+            self.db.set_failed(task_id, task['command'], str(e), CalcTimes().get_elapsed(start_time),
+                               mail=not will_retry(task, True))
+            self.ended(task_id, True, task)
+            self.metrics.finished(0, True)
+            logger.error(f"Task {task_id} failed: {e}.")
+            return
+
+        job = Job(task_id, task['command'], task['queue'], proc, start_time, output, timeout=timeout,
+                  deadline=time.monotonic() + timeout if timeout > 0 else None, policy=task)
+        for name in ('stdout', 'stderr'):
+            pipe = getattr(proc, name)
+            os.set_blocking(pipe.fileno(), False)
+            self.selector.register(pipe, selectors.EVENT_READ, (job, name))
+
+        self.jobs[task_id] = job
+
+    def timeout(self):
+        """ seconds until the loop has something to do besides reacting to events """
+        # with a wake up channel an idle daemon sleeps until a task is added
+        deadlines = [self.next_purge, self.recheck, self.next_export, self.next_heartbeat,
+                     self.api.flush_at if self.api else None]
+        deadlines += [job.deadline for job in self.jobs.values()]
+        deadlines += [kill_at for _, kill_at in self.killing.values()]
+        if self.due:
+            deadlines.append(self.due[0] - time.time() + time.monotonic())
+        timeout = max(0, min(d for d in deadlines if d is not None) - time.monotonic())
+        # killed tasks and tasks that closed their output are reaped by polling
+        polling = self.killing or any(job.pipes == 0 for job in self.jobs.values())
+        return timeout if self.wake and not polling else min(timeout, POLL_INTERVAL)
+
+    def watchdog(self):
+        """ expire tasks past their deadline, SIGKILL and reap the groups of expired ones """
+        now = time.monotonic()
+        for job in [job for job in self.jobs.values() if job.deadline and job.deadline <= now]:
+            self.expire(job)
+
+        # tasks that closed their output but still run are reaped by polling too
+        for job in [job for job in self.jobs.values() if job.pipes == 0]:
+            if has_exited(job.proc.pid):
+                self.finish(job)
+
+        for pid, (proc, kill_at) in list(self.killing.items()):
+            exited = has_exited(pid)
+            # the leader is not reaped yet, so its pid cannot name another group
+            if exited or now >= kill_at:
+                signal_group(pid, signal.SIGKILL)
+            if exited:
+                reap(proc)
+                del self.killing[pid]
+
+    def wait(self, timeout):
+        """ collect output of running tasks, finishing those that are done """
+        for key, mask in self.selector.select(timeout):
+            if key.data is None:
+                self.wake.drain()
+                self.rescan = True
+                continue
+            if callable(key.data):
+                # API sockets
+                key.data(mask)
+                continue
+
+            job, name = key.data
+            data = os.read(key.fd, READ_SIZE)
+            if data:
+                job.output[name].write(data)
+                continue
+
+            self.selector.unregister(key.fileobj)
+            key.fileobj.close()
+            job.pipes -= 1
+            # it usually exits with its output, otherwise watchdog() reaps it later
+            if job.pipes == 0 and has_exited(job.proc.pid):
+                self.finish(job)
@@ -0,0 +1,154 @@
+# pylint: disable=logging-fstring-interpolation
+# vim: set ts=4 sts=4 sw=4 et tw=0:
+""" Task output spool files """
+
+import logging
+import os
+import sys
+
+from tsp import database
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['Spool', 'print_spool', 'remove_spools', 'spool_path', 'spool_size', 'tail_path']
+
+# bytes kept from the start and from the end of each stream, the middle is dropped
+SPOOL_HEAD = int(os.getenv('TS_SPOOL_HEAD', str(1024 * 1024)))
+SPOOL_TAIL = int(os.getenv('TS_SPOOL_TAIL', str(1024 * 1024)))
+# bytes of each stream stored in the database, smaller outputs are not spooled
+SPOOL_EXCERPT = int(os.getenv('TS_SPOOL_EXCERPT', '4096'))
+
+
+def spool_path(task_id, name):
+    """ spool file of a task stream, name is stdout or stderr """
+    return os.path.join(os.path.dirname(database.DB_PATH), 'spool', f'{task_id}.{name}')
+
+
+def tail_path(task_id, name):
+    """ segment a running task writes past the head to, the full one before it gets .old """
+    return spool_path(task_id, name) + '.tail'
+
+
+def print_spool(task_id, name):
+    """ copy a spool file to stdout in chunks, False if there is none """
+    try:
+        with open(spool_path(task_id, name), 'rb') as f:
+            sys.stdout.flush()
+            while chunk := f.read(65536):
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def remove_spools(task_ids):
+    """ remove spool files of deleted tasks """
+    for task_id in task_ids:
+        for name in ('stdout', 'stderr'):
+            # and tail segments a daemon that died left behind
+            for path in (spool_path(task_id, name), tail_path(task_id, name),
+                         tail_path(task_id, name) + '.old'):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+
+def spool_size(task_id):
+    """ bytes in the spool files of a task """
+    size = 0
+    for name in ('stdout', 'stderr'):
+        try:
+            size += os.path.getsize(spool_path(task_id, name))
+        except FileNotFoundError:
+            pass
+    return size
+
+
+class Spool:
+    """
+        Capped spool file for one output stream of a running task
+
+        The first SPOOL_HEAD bytes go to the spool file, the rest to a tail
+        segment next to it that is set aside every SPOOL_TAIL bytes, so that
+        followers see all of the output while the disk holds at most two
+        segments.  close() appends the last SPOOL_TAIL bytes to the file.
+
+    """
+
+    def __init__(self, task_id, name):
+        self.path = spool_path(task_id, name)
+        self.tail = tail_path(task_id, name)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, 'wb', buffering=0) # pylint: disable=consider-using-with
+        self.size = 0
+        self.segment = None
+        self.segment_size = 0
+
+    def close(self):
+        """ write the kept tail after a truncation marker, close the file and remove the segments """
+        dropped = max(0, self.size - SPOOL_HEAD - SPOOL_TAIL)
+        if dropped:
+            self.file.write(f'\n[... {dropped} bytes truncated ...]\n'.encode())
+
+        if self.segment:
+            self.segment.close()
+            self.segment = None
+            # the rest of the tail is at the end of the segment set aside
+            rest = SPOOL_TAIL - self.segment_size
+            for path, length in ((self.tail + '.old', rest), (self.tail, self.segment_size)):
+                try:
+                    with open(path, 'rb') as f:
+                        f.seek(max(0, os.fstat(f.fileno()).st_size - length))
+                        while length > 0 and (chunk := f.read(min(length, 65536))):
+                            self.file.write(chunk)
+                            length -= len(chunk)
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+        self.file.close()
+
+    def excerpt(self):
+        """ bounded text for the database, removes the file if that holds it all """
+        length = os.path.getsize(self.path)
+        if length <= SPOOL_EXCERPT:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            os.unlink(self.path)
+            return data.decode(errors='replace') if data else None
+
+        with open(self.path, 'rb') as f:
+            f.seek(length - SPOOL_EXCERPT)
+            data = f.read()
+        return f'[... {length - SPOOL_EXCERPT} bytes in {self.path} ...]\n' + \
+            data.decode(errors='replace')
+
+    def rotate(self):
+        """ set the full tail segment aside, replacing the one before, and start a new one """
+        if self.segment:
+            self.segment.close()
+            os.replace(self.tail, self.tail + '.old')
+        self.segment = open(self.tail, 'wb', buffering=0) # pylint: disable=consider-using-with
+        self.segment_size = 0
+
+    def write(self, data):
+        """ append output, past the head to the tail segments """
+        if self.size < SPOOL_HEAD:
+            head = data[:SPOOL_HEAD - self.size]
+            self.file.write(head)
+            self.size += len(head)
+            data = data[len(head):]
+
+        if SPOOL_TAIL <= 0:
+            self.size += len(data)
+            return
+
+        while data:
+            if self.segment is None or self.segment_size >= SPOOL_TAIL:
+                self.rotate()
+            part = data[:SPOOL_TAIL - self.segment_size]
+            self.segment.write(part)
+            self.segment_size += len(part)
+            self.size += len(part)
+            data = data[len(part):]
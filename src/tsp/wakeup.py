@@ -0,0 +1,79 @@
+# pylint: disable=logging-fstring-interpolation
+# vim: set ts=4 sts=4 sw=4 et tw=0:
+""" Wake the daemons up when tasks are added """
+
+import logging
+import os
+import socket
+
+from tsp import database
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['WakeChannel', 'wake_daemon']
+
+
+def wake_dir():
+    """ folder of the datagram sockets daemons listen on, next to the database """
+    return os.path.join(os.path.dirname(database.DB_PATH), 'wake')
+
+
+def wake_daemon():
+    """ tell running daemons to look for new tasks, never blocks or fails """
+    try:
+        names = os.listdir(wake_dir())
+    except OSError:
+        return
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+        for name in names:
+            path = os.path.join(wake_dir(), name)
+            try:
+                sock.sendto(b'!', path)
+            except ConnectionRefusedError:
+                # left behind by a daemon that died
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except OSError as e:
+                # it already has wake ups queued
+                logger.debug(f"wake_daemon: {path}: {e}")
+
+
+class WakeChannel:
+    """ Daemon side of the wake up sockets, one per daemon """
+
+    def __init__(self):
+        os.makedirs(wake_dir(), exist_ok=True)
+        self.path = os.path.join(wake_dir(), f'{os.getpid()}.sock')
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.sock.bind(self.path)
+        except OSError:
+            self.sock.close()
+            raise
+        self.sock.setblocking(False)
+
+    def close(self):
+        """ stop listening """
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def drain(self):
+        """ discard queued wake ups, one check covers them all """
+        try:
+            while True:
+                self.sock.recv(64)
+        except BlockingIOError:
+            pass
+
+    def fileno(self):
+        """ socket descriptor, for selectors """
+        return self.sock.fileno()
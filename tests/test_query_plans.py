@@ -0,0 +1,82 @@
+# vim: set ts=4 sts=4 sw=4 et tw=0:
+""" The dispatch, list and maintenance queries search their indexes instead of scanning tasks """
+
+import time
+
+import pytest
+
+from tsp import database
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """ a scratch database with finished, failed, pending, running and waiting tasks """
+    monkeypatch.setattr(database, 'DB_PATH', str(tmp_path / 'tasks.db'))
+    db = database.Database()
+
+    now = int(time.time())
+    rows = []
+    for i in range(1000):
+        status = (0, 1, 2, 2, 2, 2, 4)[i % 7]
+        command = f'fetch-mail --account {i % 17}'
+        rows.append({
+            'added_at': now - 1000 + i,
+            'run_at': now - 1000 + i + 1 if status in (1, 2) else None,
+            'finished_at': now - 1000 + i + 2 if status == 2 else None,
+            'command': command,
+            'cmd_hash': database.command_hash(command),
+            'queue': 'default',
+            'status': status,
+            'result': i % 2 if status == 2 else None,
+            'time_r': 1.0 if status == 2 else None,
+            'not_before': now + i if status == 4 else None,
+            'lease_until': now + 60 if status == 1 else None,
+        })
+    with db:
+        db.insert_many('tasks', rows)
+
+    return db
+
+
+def query_plans(db, call):
+    """ run call(db) with its changes rolled back, returns the plans of the statements it ran """
+    statements = []
+    db.db.set_trace_callback(statements.append)
+    db.begin_transaction()
+    try:
+        call(db)
+    finally:
+        db.db.set_trace_callback(None)
+        db.rollback()
+
+    return [' / '.join(row[3] for row in db.db.execute(f'EXPLAIN QUERY PLAN {sql}'))
+            for sql in statements
+            if sql.lstrip().startswith(('SELECT', 'UPDATE', 'DELETE'))]
+
+
+@pytest.mark.parametrize('name, call, index', [
+    ('get_next_task', lambda db: db.get_next_task('default'), 'IDX_tasks_ready'),
+    ('pending_queues', lambda db: db.pending_queues(), 'IDX_tasks_ready'),
+    ('list_pending_tasks', lambda db: db.list_pending_tasks(50), 'IDX_tasks_pending'),
+    ('list_failed_tasks', lambda db: db.list_failed_tasks(50), 'IDX_tasks_failed'),
+    ('list_finished_tasks', lambda db: db.list_finished_tasks(50), 'IDX_tasks_finished'),
+    ('list_waiting_tasks', lambda db: db.list_waiting_tasks(50), 'IDX_tasks_waiting_list'),
+    ('iter_tasks', lambda db: list(db.iter_tasks('failed')), 'IDX_tasks_failed'),
+    ('coalesce', lambda db: db.coalesce('fetch-mail --account 3'), 'IDX_tasks_hash'),
+    ('delete_command', lambda db: db.delete_command('fetch-mail --account 3'), 'IDX_tasks_hash'),
+    ('next_due', lambda db: db.next_due(), 'IDX_tasks_waiting'),
+    ('promote_due', lambda db: db.promote_due(int(time.time())), 'IDX_tasks_waiting'),
+    ('requeue_expired', lambda db: db.requeue_expired(int(time.time())), 'IDX_tasks_leases'),
+    ('purge_step', lambda db: db.purge_step(), 'IDX_tasks_done'),
+    ('stats', lambda db: db.stats(int(time.time()) - 3600), 'IDX_tasks_stats'),
+])
+def test_query_uses_index(db, name, call, index):
+    """ the first statement a method runs searches its index """
+    # get_next_task claims in a transaction of its own where RETURNING is missing
+    if name == 'get_next_task' and not database.CLAIM_RETURNING:
+        pytest.skip('needs SQLite 3.35')
+
+    plans = query_plans(db, call)
+    assert plans, f'{name} ran no statement'
+    assert index in plans[0], f'{name} does not use {index}: {plans}'
+
@@ -0,0 +1,70 @@
+# vim: set ts=4 sts=4 sw=4 et tw=0:
+""" Daemons that serve different queues of one database run each other's tasks as they become ready """
+
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from tsp import database
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+# well below the heartbeat, which would find the tasks anyway
+DEADLINE = 8
+
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+    """ a scratch home with two daemons, one for queue a and one for queue b """
+    env = dict(os.environ, HOME=str(tmp_path), PYTHONPATH=SRC)
+    os.makedirs(tmp_path / '.cache')
+    monkeypatch.setattr(database, 'DB_PATH', str(tmp_path / '.local/share/tsp/tasks.db'))
+
+    daemons = [subprocess.Popen([sys.executable, '-m', 'tsp', '--run', '-Q', queue], env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+               for queue in ('a', 'b')]
+    wake = tmp_path / '.local/share/tsp/wake'
+    try:
+        deadline = time.monotonic() + DEADLINE
+        while not (wake.is_dir() and len(os.listdir(wake)) == 2):
+            assert time.monotonic() < deadline, 'the daemons did not start'
+            time.sleep(0.05)
+        yield env
+    finally:
+        for daemon in daemons:
+            daemon.terminate()
+            daemon.wait()
+
+
+def add(env, *args):
+    """ add a task through the command line """
+    subprocess.run([sys.executable, '-m', 'tsp', *args], env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+
+
+def wait_finished(task_id):
+    """ whether the task finished before the deadline """
+    db = database.Database()
+    deadline = time.monotonic() + DEADLINE
+    while time.monotonic() < deadline:
+        state = db.get_state(task_id)
+        if state and state['status'] == 2:
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def test_dependent_in_other_queue(home):
+    """ a child in queue b runs once the daemon of queue a finished its parent """
+    add(home, '-Q', 'a', 'sleep', '1')
+    add(home, '-Q', 'b', '--after', '1', 'true')
+    assert wait_finished(1)
+    assert wait_finished(2)
+
+
+def test_due_task_in_other_queue(home):
+    """ a delayed task in queue b runs whichever daemon promoted it """
+    add(home, '-Q', 'b', '--in', '2', 'true')
+    assert wait_finished(1)